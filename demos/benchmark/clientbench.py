@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#
+# Copyright 2010 Dusty Phillips
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measures how many small responses an HTTP client can fetch per second.
+
+The server runs on the same IOLoop as the client, and its responses are a
+few bytes long, so the time is dominated by per-request overhead: setting
+up curl handles (--client=curl, the default) or building requests and
+parsing responses (--client=simple). Run with --logging=warning to keep
+the server's request log out of the measurement.
+"""
+
+import time
+import psyclone.httpclient
+import psyclone.httpserver
+import psyclone.ioloop
+import psyclone.options
+import psyclone.simple_httpclient
+import psyclone.web
+
+from psyclone.options import define, options
+
+define("num", default=10000, help="number of requests to make", type=int)
+define("concurrency", default=10, help="requests in flight at once",
+       type=int)
+define("client", default="curl", help="client to use (curl or simple)")
+define("port", default=8889, help="port for the local server", type=int)
+
+
+class SmallHandler(psyclone.web.RequestHandler):
+    def get(self):
+        self.write("ok")
+
+
+def main():
+    psyclone.options.parse_command_line()
+    io_loop = psyclone.ioloop.IOLoop.instance()
+    application = psyclone.web.Application([(r"/", SmallHandler)])
+    server = psyclone.httpserver.HTTPServer(application)
+    server.listen(options.port, "127.0.0.1")
+    if options.client == "simple":
+        client = psyclone.simple_httpclient.SimpleAsyncHTTPClient(
+            max_clients=options.concurrency,
+            max_per_host=options.concurrency)
+    else:
+        client = psyclone.httpclient.AsyncHTTPClient(
+            max_clients=options.concurrency)
+    url = "http://127.0.0.1:%d/" % options.port
+    errors = []
+    def on_response(response):
+        if response.error:
+            errors.append(response.error)
+    start = time.time()
+    client.fetch_many((url for i in range(options.num)), on_response,
+                      io_loop.stop, concurrency=options.concurrency)
+    io_loop.start()
+    elapsed = time.time() - start
+    print("%d requests in %.2fs: %d per second, %d errors" % (
+        options.num, elapsed, options.num / elapsed, len(errors)))
+
+
+if __name__ == "__main__":
+    main()
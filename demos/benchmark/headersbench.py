@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+#
+# Copyright 2010 Dusty Phillips
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measures how many response header blocks we can generate per second.
+
+Each iteration sets a typical handful of headers on a RequestHandler and
+serializes them, which is the per-response cost outside of the handler's
+own work.
+"""
+
+import time
+import psyclone.httpserver
+import psyclone.options
+import psyclone.web
+
+from psyclone.options import define, options
+
+define("num", default=100000, help="number of header blocks to generate",
+       type=int)
+
+
+class FakeStream:
+    def set_close_callback(self, callback):
+        pass
+
+
+class FakeConnection:
+    stream = FakeStream()
+    xheaders = False
+
+
+def main():
+    psyclone.options.parse_command_line()
+    application = psyclone.web.Application([])
+    request = psyclone.httpserver.HTTPRequest(
+        "GET", "/", version="HTTP/1.1",
+        headers=psyclone.httpserver.HTTPHeaders(),
+        connection=FakeConnection())
+    handler = psyclone.web.RequestHandler(application, request)
+    start = time.time()
+    for i in range(options.num):
+        handler.clear()
+        handler.set_header("Content-Length", 1024)
+        handler.set_header("Cache-Control", "public")
+        handler.set_header("Etag", '"%08x-400"' % i)
+        handler._generate_headers()
+    elapsed = time.time() - start
+    print("%d header blocks in %.2fs: %d per second" % (
+        options.num, elapsed, options.num / elapsed))
+
+
+if __name__ == "__main__":
+    main()
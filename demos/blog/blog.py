@@ -130,8 +130,9 @@ class ComposeHandler(BaseHandler):
             if not entry: raise psyclone.web.HTTPError(404)
             slug = entry['slug']
             self.db.prepare(
-                "UPDATE entries SET title = $1, markdown = $2, html = $3 "
-                "WHERE id = $4")(title, text, html, int(id))
+                "UPDATE entries SET title = $1, markdown = $2, html = $3, "
+                "updated = CURRENT_TIMESTAMP WHERE id = $4")(
+                    title, text, html, int(id))
         else:
             slug = unicodedata.normalize("NFKD", title)
             slug = re.sub(r"[^\w]+", " ", slug)
@@ -16,3 +16,6 @@
 # under the License.
 
 """The Tornado web server and tools."""
+
+version = "0.2"
+version_info = (0, 2, 0)
@@ -145,7 +145,7 @@ class OpenIdMixin:
         return args
 
     def _on_authentication_verified(self, callback, response):
-        if response.error or "is_valid:true" not in response.body:
+        if response.error or b"is_valid:true" not in response.body:
             logging.warning("Invalid OpenID response: %s", response.error or
                             response.body)
             callback(None)
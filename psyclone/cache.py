@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Dusty Phillips
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Bounded in-memory caches, and stores for cached fragments of output.
+
+LRUCache is a size-bounded dictionary used throughout psyclone. The stores
+(MemoryStore and FileStore) hold values that expire after a time-to-live;
+they back the {% cache %} template directive and share a small interface:
+
+    store.get(key)              # the cached value, or None
+    store.set(key, value, ttl)  # ttl in seconds, or None for no expiry
+
+MemoryStore is private to each process. FileStore is shared by every
+process that points at the same directory, so pre-forked workers render
+each fragment once between them; put the directory on a memory-backed
+file system like /dev/shm to share through memory rather than disk.
+"""
+
+import collections
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import time
+
+
+class LRUCache:
+    """A dictionary-like cache that evicts its least recently used entries.
+
+    The cache can be bounded by the number of entries (max_entries), by the
+    total size of its values (max_size), or both. Sizes are measured with
+    the sizeof function, which defaults to sys.getsizeof. A value larger
+    than max_size on its own is never stored.
+
+    We count hits, misses and evictions, which you can read with stats():
+
+        cache = LRUCache(max_entries=100)
+        cache["key"] = "value"
+        cache.get("key")
+        print cache.stats()
+
+    Only get() counts hits and misses; "key in cache" does not, and does not
+    mark the entry as recently used.
+    """
+    def __init__(self, max_entries=None, max_size=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof or sys.getsizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """Returns the value for key, or default if it is not cached."""
+        try:
+            value, size = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def pop(self, key, default=None):
+        """Removes key from the cache, returning its value or default."""
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """Returns a dictionary of the size and counters of this cache."""
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        size = self.sizeof(value) if self.max_size is not None else 0
+        if self.max_size is not None and size > self.max_size:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while (self.max_entries is not None and
+               len(self._entries) > self.max_entries) or \
+              (self.max_size is not None and self.size > self.max_size):
+            evicted_key, (evicted, evicted_size) = self._entries.popitem(
+                last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        if self.pop(key, _MISSING) is _MISSING:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+
+def file_signature(path):
+    """Returns a value that changes whenever the file at path is modified.
+
+    The value is None if the file does not exist. Caches of things built
+    from files compare signatures to decide whether to rebuild.
+    """
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return (stat_result.st_mtime, stat_result.st_ino, stat_result.st_size)
+
+
+class MemoryStore:
+    """Keeps values in an LRUCache in this process.
+
+    max_entries and max_size bound the underlying LRUCache; sizes are
+    measured with sys.getsizeof.
+    """
+    def __init__(self, max_entries=1000, max_size=None):
+        self._cache = LRUCache(max_entries=max_entries, max_size=max_size,
+                               sizeof=lambda entry: sys.getsizeof(entry[0]))
+
+    def get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires < time.time():
+            self._cache.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        self._cache[key] = (value, expires)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class FileStore:
+    """Keeps values in files in a directory shared between processes.
+
+    Values must be serializable with the marshal module (e.g., str or
+    bytes). Expired files are removed when they are next read.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            expires, value = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            logging.warning("Ignoring corrupt cache file %s", path)
+            return None
+        finally:
+            f.close()
+        if expires is not None and expires < time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        path = self._path(key)
+        # Rename into place so other processes never read a partial file
+        temp_path = "%s.%d" % (path, os.getpid())
+        try:
+            f = open(temp_path, "wb")
+            try:
+                marshal.dump((expires, value), f)
+            finally:
+                f.close()
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            logging.warning("Could not write cache file %s", path,
+                            exc_info=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(str(key).encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+
+_MISSING = object()
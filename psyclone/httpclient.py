@@ -15,21 +15,34 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-"""Blocking and non-blocking HTTP client implementations using pycurl."""
+"""Blocking and non-blocking HTTP client implementations using pycurl.
 
+See simple_httpclient for a non-blocking client that does not need pycurl.
+"""
+
+import bisect
+from . import cache
 import calendar
 import collections
-import io
+import concurrent.futures
+import copy
 import email.utils
-import errno
 import functools
 import http.client
+from . import httpserver
 from . import ioloop
 import logging
-import pycurl
+import os
+import socket
 import time
+import urllib.parse
 from .byte_utils import force_str
 
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
 class HTTPClient:
     """A blocking HTTP client backed with pycurl.
 
@@ -44,9 +57,13 @@ class HTTPClient:
 
     fetch() can take a string URL or an HTTPRequest instance, which offers
     more options, like executing POST/PUT/DELETE requests.
+
+    Pass an HTTPCache as cache to reuse responses to GET requests as HTTP
+    caching rules allow.
     """
-    def __init__(self, max_simultaneous_connections=None):
+    def __init__(self, max_simultaneous_connections=None, cache=None):
         self._curl = _curl_create(max_simultaneous_connections)
+        self.cache = cache
 
     def __del__(self):
         self._curl.close()
@@ -58,22 +75,30 @@ class HTTPClient:
         """
         if not isinstance(request, HTTPRequest):
            request = HTTPRequest(url=request, **kwargs)
-        buffer = io.StringIO()
+        sent_request, entry = request, None
+        if self.cache is not None:
+            response = self.cache.get(request)
+            if response is not None:
+                return response
+            sent_request, entry = self.cache.prepare(request)
+        buffer = _ResponseBuffer()
         headers = {}
         try:
-            _curl_setup_request(self._curl, request, buffer, headers)
+            _curl_setup_request(self._curl, sent_request, buffer, headers)
             self._curl.perform()
-            code = self._curl.getinfo(pycurl.HTTP_CODE)
-            if code < 200 or code >= 300:
-                raise HTTPError(code)
-            effective_url = self._curl.getinfo(pycurl.EFFECTIVE_URL)
-            return HTTPResponse(
-                request=request, code=code, headers=headers,
-                body=buffer.getvalue(), effective_url=effective_url)
         except pycurl.error as e:
             raise CurlError(*e)
         finally:
-            buffer.close()
+            _curl_release(self._curl)
+        response = HTTPResponse(
+            request=request, code=self._curl.getinfo(pycurl.HTTP_CODE),
+            headers=headers, body=buffer.getvalue(),
+            effective_url=self._curl.getinfo(pycurl.EFFECTIVE_URL),
+            time_info=_curl_time_info(self._curl))
+        if self.cache is not None:
+            response = self.cache.update(request, response, entry)
+        response.rethrow()
+        return response
 
 
 class AsyncHTTPClient:
@@ -99,12 +124,37 @@ class AsyncHTTPClient:
 
     The keyword argument max_clients to the AsyncHTTPClient constructor
     determines the maximum number of simultaneous fetch() operations that
-    can execute in parallel on each IOLoop.
+    can execute in parallel on each IOLoop, and max_per_host (if given)
+    limits how many of them go to any one host and port. The rest wait in
+    a RequestQueue, which starts requests by HTTPRequest.priority and takes
+    turns between hosts, so a batch of fetches to one slow host does not
+    hold up everything else; its stats() describe the backlog. Every
+    response records how long it waited for a free handle in
+    response.time_info["queue"], and the client's timing attribute (a
+    TimingStats) aggregates the phases of every request by host.
+
+    If cache is an HTTPCache, GET responses are reused and revalidated as
+    HTTP caching rules allow. The cache attribute can also be set later,
+    since the constructor only configures the first client on each IOLoop.
+
+    With coalesce=True, a GET or HEAD fetched while an identical one is
+    still in flight is not sent again; its callback gets the response to
+    the first (see RequestCoalescer).
+
+    If resolver is a DNSCache, host names are looked up there before a
+    request is queued and handed to curl with CURLOPT_RESOLVE (libcurl
+    7.21.3 or later), so every handle shares the results and a slow
+    resolver never blocks the IOLoop.
+
+    We drive curl with its socket_action interface (pycurl 7.18.2 or
+    later): curl tells us which file descriptors to watch and when to time
+    out, so each event only touches the descriptor it happened on.
     """
     _ASYNC_CLIENTS = {}
 
     def __new__(cls, io_loop=None, max_clients=10,
-                max_simultaneous_connections=None):
+                max_simultaneous_connections=None, max_per_host=None,
+                cache=None, coalesce=False, resolver=None):
         # There is one client per IOLoop since they share curl instances
         io_loop = io_loop or ioloop.IOLoop.instance()
         if id(io_loop) in cls._ASYNC_CLIENTS:
@@ -112,15 +162,29 @@ class AsyncHTTPClient:
         else:
             instance = super(AsyncHTTPClient, cls).__new__(cls)
             instance.io_loop = io_loop
-            instance._multi = pycurl.CurlMulti()
             instance._curls = [_curl_create(max_simultaneous_connections)
                                for i in range(max_clients)]
+            instance._multi = pycurl.CurlMulti()
+            instance._multi.setopt(pycurl.M_TIMERFUNCTION,
+                                   instance._set_timeout)
+            instance._multi.setopt(pycurl.M_SOCKETFUNCTION,
+                                   instance._handle_socket)
             instance._free_list = instance._curls[:]
-            instance._requests = collections.deque()
+            instance.max_per_host = max_per_host
+            instance.queue = RequestQueue()
+            instance._active = {}
             instance._fds = {}
-            instance._events = {}
-            instance._added_perform_callback = False
             instance._timeout = None
+            instance.timing = TimingStats()
+            instance.cache = cache
+            instance.coalescer = RequestCoalescer() if coalesce else None
+            instance.resolver = resolver \
+                if hasattr(pycurl, "RESOLVE") else None
+            # curl should tell us about every timeout it needs, but check
+            # in with it every second in case it ever does not
+            instance._force_timeout_callback = ioloop.PeriodicCallback(
+                instance._handle_force_timeout, 1000, io_loop=io_loop)
+            instance._force_timeout_callback.start()
             cls._ASYNC_CLIENTS[id(io_loop)] = instance
             return instance
 
@@ -134,106 +198,178 @@ class AsyncHTTPClient:
         """
         if not isinstance(request, HTTPRequest):
            request = HTTPRequest(url=request, **kwargs)
-        self._requests.append((request, callback))
-        self._add_perform_callback()
+        if self.cache is not None:
+            response = self.cache.get(request)
+            if response is not None:
+                self.io_loop.add_callback(functools.partial(
+                    callback, response))
+                return
+        if self.coalescer is not None:
+            callback = self.coalescer.join(request, callback)
+            if callback is None:
+                return
+        if self.cache is not None:
+            request, callback = self.cache.wrap(request, callback)
+        parsed = urllib.parse.urlsplit(request.url)
+        if self.resolver is not None and parsed.hostname:
+            port = parsed.port or {"https": 443}.get(parsed.scheme, 80)
+            self.resolver.resolve(parsed.hostname, port, functools.partial(
+                self._on_resolved, request, callback, time.time(),
+                parsed.hostname, port))
+        else:
+            self._queue_request(request, callback, time.time(), None)
+
+    def _on_resolved(self, request, callback, queue_start_time, host, port,
+                     addresses, error):
+        resolve = None
+        if addresses:
+            address = addresses[0][4][0]
+            if ":" in address:
+                address = "[%s]" % address
+            resolve = ["%s:%d:%s" % (host, port, address)]
+        # If the lookup failed, curl tries again and reports the error
+        self._queue_request(request, callback, queue_start_time, resolve)
+
+    def _queue_request(self, request, callback, queue_start_time, resolve):
+        self.queue.append(_host_key(request.url), request.priority,
+                          (request, callback, queue_start_time, resolve))
+        self._process_queue()
+        self._set_timeout(0)
+
+    def fetch_many(self, requests, callback_per_response, on_done=None,
+                   concurrency=10):
+        """Fetches requests, at most concurrency at a time.
 
-    def _add_perform_callback(self):
-        if not self._added_perform_callback:
-            self.io_loop.add_callback(self._perform)
-            self._added_perform_callback = True
+        requests is an iterable of HTTPRequests or URLs, which we only
+        advance as earlier fetches complete, so it can be a generator over
+        more URLs than fit in memory. callback_per_response is called with
+        each HTTPResponse in the order they complete, and on_done (if
+        given) with no arguments once they all have. See fetch_iter() for a
+        blocking variant.
+        """
+        _BatchFetch(self.fetch, requests, callback_per_response, on_done,
+                    concurrency).start()
+
+    def _handle_socket(self, event, fd, multi, data):
+        """Called by curl when the events it wants on fd change."""
+        event_map = {
+            pycurl.POLL_NONE: ioloop.IOLoop.NONE,
+            pycurl.POLL_IN: ioloop.IOLoop.READ,
+            pycurl.POLL_OUT: ioloop.IOLoop.WRITE,
+            pycurl.POLL_INOUT: ioloop.IOLoop.READ | ioloop.IOLoop.WRITE,
+        }
+        if event == pycurl.POLL_REMOVE:
+            if fd in self._fds:
+                self.io_loop.remove_handler(fd)
+                del self._fds[fd]
+        else:
+            events = event_map[event]
+            if fd not in self._fds:
+                self.io_loop.add_handler(fd, self._handle_events, events)
+            elif self._fds[fd] != events:
+                self.io_loop.update_handler(fd, events)
+            self._fds[fd] = events
+
+    def _set_timeout(self, msecs):
+        """Called by curl to schedule a timeout."""
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if msecs >= 0:
+            self._timeout = self.io_loop.add_timeout(
+                time.time() + msecs / 1000.0, self._handle_timeout)
 
     def _handle_events(self, fd, events):
-        self._events[fd] = events
-        self._add_perform_callback()
+        """Called by the IOLoop when there is activity on one of our fds."""
+        action = 0
+        if events & ioloop.IOLoop.READ:
+            action |= pycurl.CSELECT_IN
+        if events & ioloop.IOLoop.WRITE:
+            action |= pycurl.CSELECT_OUT
+        if events & ioloop.IOLoop.ERROR:
+            action |= pycurl.CSELECT_ERR
+        self._socket_action(fd, action)
 
     def _handle_timeout(self):
+        """Called by the IOLoop when the timeout curl asked for passes."""
         self._timeout = None
-        self._perform()
-
-    def _perform(self):
-        self._added_perform_callback = False
+        self._socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        # curl measures its timeouts with a monotonic clock, and we use
+        # time.time(), so we may have woken it too early. Reschedule with
+        # whatever curl wants now.
+        new_timeout = self._multi.timeout()
+        if new_timeout >= 0:
+            self._set_timeout(new_timeout)
 
+    def _handle_force_timeout(self):
+        """Called every second in case curl missed a timeout."""
         while True:
-            while True:
-                ret, num_handles = self._multi.perform()
-                if ret != pycurl.E_CALL_MULTI_PERFORM:
-                    break
-
-            # Handle completed fetches
-            completed = 0
-            while True:
-                num_q, ok_list, err_list = self._multi.info_read()
-                for curl in ok_list:
-                    self._finish(curl)
-                    completed += 1
-                for curl, errnum, errmsg in err_list:
-                    self._finish(curl, errnum, errmsg)
-                    completed += 1
-                if num_q == 0:
-                    break
+            try:
+                ret, num_handles = self._multi.socket_all()
+            except pycurl.error as e:
+                ret = e.args[0]
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        self._finish_pending_requests()
 
-            # Start fetching new URLs
-            started = 0
-            while self._free_list and self._requests:
-                started += 1
-                curl = self._free_list.pop()
-                (request, callback) = self._requests.popleft()
-                curl.info = {
-                    "headers": {},
-                    "buffer": io.StringIO(),
-                    "request": request,
-                    "callback": callback,
-                    "start_time": time.time(),
-                }
-                _curl_setup_request(curl, request, curl.info["buffer"],
-                                    curl.info["headers"])
-                self._multi.add_handle(curl)
-
-            if not started and not completed:
+    def _socket_action(self, fd, action):
+        while True:
+            try:
+                ret, num_handles = self._multi.socket_action(fd, action)
+            except pycurl.error as e:
+                ret = e.args[0]
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
                 break
+        self._finish_pending_requests()
 
-        if self._timeout is not None:
-            self.io_loop.remove_timeout(self._timeout)
-            self._timeout = None
+    def _finish_pending_requests(self):
+        """Handles the requests completed by the last socket_action."""
+        while True:
+            num_q, ok_list, err_list = self._multi.info_read()
+            for curl in ok_list:
+                self._finish(curl)
+            for curl, errnum, errmsg in err_list:
+                self._finish(curl, errnum, errmsg)
+            if num_q == 0:
+                break
+        self._process_queue()
 
-        if num_handles:
-            self._timeout = self.io_loop.add_timeout(
-                time.time() + 0.2, self._handle_timeout)
-
-        # Wait for more I/O
-        fds = {}
-        (readable, writable, exceptable) = self._multi.fdset()
-        for fd in readable:
-            fds[fd] = fds.get(fd, 0) | 0x1 | 0x2
-        for fd in writable:
-            fds[fd] = fds.get(fd, 0) | 0x4
-        for fd in exceptable:
-            fds[fd] = fds.get(fd, 0) | 0x8 | 0x10
-
-        for fd in self._fds:
-            if fd not in fds:
-                self.io_loop.remove_handler(fd)
+    def _process_queue(self):
+        """Starts fetching queued requests while there are free handles."""
+        while self._free_list and self.queue:
+            entry = self.queue.pop(self._can_start)
+            if entry is None:
+                # Every queued host is at its max_per_host limit
+                break
+            key, (request, callback, queue_start_time, resolve) = entry
+            self._active[key] = self._active.get(key, 0) + 1
+            curl = self._free_list.pop()
+            curl.info = {
+                "key": key,
+                "headers": {},
+                "buffer": _ResponseBuffer(),
+                "request": request,
+                "callback": callback,
+                "queue_start_time": queue_start_time,
+                "start_time": time.time(),
+            }
+            _curl_setup_request(curl, request, curl.info["buffer"],
+                                curl.info["headers"], resolve)
+            self._multi.add_handle(curl)
 
-        for fd, events in fds.items():
-            old_events = self._fds.get(fd, None)
-            if old_events is None:
-                self.io_loop.add_handler(fd, self._handle_events, events)
-            elif old_events != events:
-                try:
-                    self.io_loop.update_handler(fd, events)
-                except OSError as e:
-                    if e[0] == errno.ENOENT:
-                        self.io_loop.add_handler(fd, self._handle_events,
-                                                 events)
-                    else:
-                        raise
-        self._fds = fds
+    def _can_start(self, key):
+        return self.max_per_host is None or \
+            self._active.get(key, 0) < self.max_per_host
 
     def _finish(self, curl, curl_error=None, curl_message=None):
         info = curl.info
         curl.info = None
+        _curl_release(curl)
         self._multi.remove_handle(curl)
         self._free_list.append(curl)
+        self._active[info["key"]] -= 1
+        if not self._active[info["key"]]:
+            del self._active[info["key"]]
         if curl_error:
             error = CurlError(curl_error, curl_message)
             code = error.code
@@ -244,20 +380,107 @@ class AsyncHTTPClient:
             code = curl.getinfo(pycurl.HTTP_CODE)
             body = info["buffer"].getvalue()
             effective_url = curl.getinfo(pycurl.EFFECTIVE_URL)
-        info["buffer"].close()
+        time_info = _curl_time_info(curl)
+        time_info["queue"] = info["start_time"] - info["queue_start_time"]
+        self.timing.add(info["request"].url, time_info)
         info["callback"](HTTPResponse(
             request=info["request"], code=code, headers=info["headers"],
             body=body, effective_url=effective_url, error=error,
-            request_time=time.time() - info["start_time"]))
+            request_time=time.time() - info["start_time"],
+            time_info=time_info))
+
+
+def fetch_iter(client, requests, concurrency=10):
+    """Fetches requests with client.fetch_many(), yielding the responses.
+
+    Responses are yielded as they complete. We run the client's IOLoop
+    until the next response is ready, so it should be an IOLoop of its own
+    that is not otherwise running:
+
+        client = httpclient.AsyncHTTPClient(io_loop=ioloop.IOLoop())
+        for response in httpclient.fetch_iter(client, urls):
+            print response.code, response.effective_url
+    """
+    io_loop = client.io_loop
+    responses = collections.deque()
+    done = []
+    def on_response(response):
+        responses.append(response)
+        io_loop.stop()
+    def on_done():
+        done.append(True)
+        io_loop.stop()
+    client.fetch_many(requests, on_response, on_done, concurrency)
+    while True:
+        while responses:
+            yield responses.popleft()
+        if done:
+            return
+        io_loop.start()
+
+
+class _BatchFetch:
+    """The state of one fetch_many() call."""
+    def __init__(self, fetch, requests, callback, on_done, concurrency):
+        self.fetch = fetch
+        self.requests = iter(requests)
+        self.callback = callback
+        self.on_done = on_done
+        self.concurrency = concurrency
+        self.active = 0
+        self.exhausted = False
+        self.starting = False
+
+    def start(self):
+        # A response may arrive while we are in fetch() (e.g., from a
+        # cache), so do not start requests recursively
+        if self.starting:
+            return
+        self.starting = True
+        try:
+            while not self.exhausted and self.active < self.concurrency:
+                try:
+                    request = next(self.requests)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+                self.active += 1
+                self.fetch(request, self._on_response)
+        finally:
+            self.starting = False
+        if self.exhausted and not self.active and self.on_done is not None:
+            on_done = self.on_done
+            self.on_done = None
+            on_done()
+
+    def _on_response(self, response):
+        self.active -= 1
+        self.callback(response)
+        self.start()
 
 
 class HTTPRequest:
-    def __init__(self, url, method="GET", headers={}, body=None,
+    """A request to fetch.
+
+    body may be bytes, a str (sent as UTF-8), a memoryview or other buffer,
+    or a seekable file object opened in binary mode, which is sent from its
+    current position to its end. Bodies are handed to curl (or the socket)
+    piece by piece, so large bodies are never copied in full.
+
+    Queued requests with a lower priority value start first; the default
+    is 0, so background work can use a positive priority to make way for
+    requests that someone is waiting on.
+    """
+    def __init__(self, url, method="GET", headers=None, body=None,
                  auth_username=None, auth_password=None,
                  connect_timeout=None, request_timeout=None,
                  if_modified_since=None, follow_redirects=True,
                  max_redirects=5, user_agent=None, use_gzip=True,
-                 network_interface=None, streaming_callback=None):
+                 network_interface=None, streaming_callback=None,
+                 priority=0):
+        # We add headers below, so copy them rather than change the
+        # caller's (or the shared default) dictionary
+        headers = dict(headers or {})
         if if_modified_since:
             timestamp = calendar.timegm(if_modified_since.utctimetuple())
             headers["If-Modified-Since"] = email.utils.formatdate(
@@ -278,11 +501,28 @@ class HTTPRequest:
         self.use_gzip = use_gzip
         self.network_interface = network_interface
         self.streaming_callback = streaming_callback
+        self.priority = priority
 
 
 class HTTPResponse:
+    """The result of a fetch.
+
+    request_time is the number of seconds the request took once it
+    started. time_info breaks that down into phases, in seconds:
+
+        queue: waiting for the client to start the request
+        namelookup: resolving the host name
+        connect: until the TCP connection was established
+        appconnect: until the SSL handshake completed (0 without SSL)
+        pretransfer: until the request was about to be sent
+        starttransfer: until the first byte of the response arrived
+        total: until the response was complete
+
+    All but queue are counted from when the request started, so each
+    includes the phases before it, as in curl.
+    """
     def __init__(self, request, code, headers={}, body="", effective_url=None,
-                 error=None, request_time=None):
+                 error=None, request_time=None, time_info=None):
         self.request = request
         self.code = code
         self.headers = headers
@@ -299,6 +539,7 @@ class HTTPResponse:
         else:
             self.error = error
         self.request_time = request_time
+        self.time_info = time_info or {}
 
     def rethrow(self):
         if self.error:
@@ -309,6 +550,522 @@ class HTTPResponse:
         return "%s(%s)" % (self.__class__.__name__, args)
 
 
+class TimingStats:
+    """Histograms of request phase timings, kept per host.
+
+    Each phase in HTTPResponse.time_info is counted into buckets whose
+    upper bounds (in seconds) are given by BUCKETS. A long queue time with
+    short connect and starttransfer times means the client has too few
+    connections; the opposite means the upstream host is slow.
+
+        stats = http_client.timing.get("www.example.com:80")
+        print stats["queue"]["count"], stats["queue"]["buckets"]
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+               5.0, 10.0, float("inf"))
+
+    def __init__(self):
+        self._hosts = {}
+
+    def add(self, url, time_info):
+        """Counts the phases of a request to the given URL."""
+        phases = self._hosts.setdefault(_host_key(url), {})
+        for phase, seconds in time_info.items():
+            histogram = phases.get(phase)
+            if histogram is None:
+                histogram = phases[phase] = [0, 0.0, [0] * len(self.BUCKETS)]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def hosts(self):
+        return list(self._hosts)
+
+    def get(self, host):
+        """Returns the histograms for a "host:port".
+
+        The result maps each phase to a dictionary with its count, the sum
+        of its times, and a list of (upper bound, count) buckets.
+        """
+        return dict((phase, {
+            "count": count,
+            "sum": total,
+            "buckets": list(zip(self.BUCKETS, buckets)),
+        }) for phase, (count, total, buckets)
+            in self._hosts.get(host, {}).items())
+
+
+class HTTPCache:
+    """Responses to GET requests, kept and revalidated per HTTP caching.
+
+    Responses are stored unless their Cache-Control says no-store, and are
+    reused without a request while they are fresh: for max-age seconds, or
+    until Expires, or for a tenth of the time since Last-Modified (at most
+    a day). Stale responses with an Etag or Last-Modified are revalidated
+    with If-None-Match and If-Modified-Since, and a 304 response refreshes
+    the stored one. Requests that already carry conditional headers bypass
+    the cache, since their callers want to see the 304 themselves.
+
+    Responses to authenticated requests (with auth_username or an
+    Authorization header) are only stored if they are marked public or
+    have an s-maxage, as for shared caches in RFC 2616 section 14.8, and
+    authenticated requests are only answered from such responses. The
+    cache is keyed by URL, so anything else could serve one user's
+    response to another.
+
+    The cache holds at most max_size bytes of bodies, evicting the least
+    recently used responses. Pass it to a client as cache:
+
+        http_client = httpclient.AsyncHTTPClient(cache=httpclient.HTTPCache())
+
+    stats() adds the number of fresh hits, revalidations, and responses
+    stored to the counters of the underlying LRUCache.
+    """
+    # Heuristic freshness, as a fraction of the age of Last-Modified
+    HEURISTIC_FRACTION = 0.1
+    MAX_HEURISTIC_LIFETIME = 24 * 60 * 60
+
+    def __init__(self, max_size=16 * 1024 * 1024):
+        self._cache = cache.LRUCache(
+            max_size=max_size, sizeof=lambda entry: len(entry.body))
+        self.fresh_hits = 0
+        self.revalidations = 0
+        self.stored = 0
+
+    def get(self, request):
+        """Returns a fresh cached response to request, or None."""
+        entry = self._lookup(request)
+        if entry is None or entry.expires <= time.time() or \
+           "no-cache" in _cache_control(request.headers):
+            return None
+        self.fresh_hits += 1
+        return entry.response(request)
+
+    def prepare(self, request):
+        """Returns (request to send, stale entry) for a cache miss.
+
+        If we have a stale response with validators, the request to send is
+        a conditional copy of request, and the entry should be passed on to
+        update().
+        """
+        entry = self._lookup(request)
+        if entry is None or not (entry.etag or entry.last_modified):
+            return request, None
+        conditional = copy.copy(request)
+        conditional.headers = dict(request.headers)
+        if entry.etag:
+            conditional.headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            conditional.headers["If-Modified-Since"] = entry.last_modified
+        return conditional, entry
+
+    def update(self, request, response, entry=None):
+        """Stores response to request, and returns the response to use.
+
+        A 304 in reply to a request from prepare() returns the refreshed
+        entry instead. Successful unsafe requests (e.g., POST) remove any
+        response stored for their URL.
+        """
+        if request.method not in ("GET", "HEAD"):
+            if response.error is None:
+                self._cache.pop(request.url)
+            return response
+        if request.method != "GET" or _conditional(request.headers):
+            return response
+        if response.code == 304 and entry is not None:
+            headers = httpserver.HTTPHeaders()
+            headers.update(entry.headers)
+            for name, value in response.headers.items():
+                if name.lower() not in ("content-length",
+                                        "transfer-encoding"):
+                    headers[name] = value
+            self.revalidations += 1
+            entry = self._store(request, headers, entry.body,
+                                entry.effective_url) or entry
+            return entry.response(request, response)
+        if response.code == 200 and response.error is None:
+            self._store(request, response.headers, response.body,
+                        response.effective_url)
+        return response
+
+    def wrap(self, request, callback):
+        """Returns (request to send, callback) for an asynchronous fetch."""
+        sent_request, entry = self.prepare(request)
+        def on_response(response):
+            response.request = request
+            callback(self.update(request, response, entry))
+        return sent_request, on_response
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats.update(fresh_hits=self.fresh_hits,
+                     revalidations=self.revalidations, stored=self.stored)
+        return stats
+
+    def _lookup(self, request):
+        if request.method != "GET" or _conditional(request.headers):
+            return None
+        entry = self._cache.get(request.url)
+        if entry is None or (_authenticated(request) and not entry.public):
+            return None
+        for name, value in entry.vary.items():
+            if _header(request.headers, name) != value:
+                return None
+        return entry
+
+    def _store(self, request, response_headers, body, effective_url):
+        headers = httpserver.HTTPHeaders()
+        for name, value in response_headers.items():
+            headers[name] = value
+        cache_control = _cache_control(headers)
+        vary = [name.strip() for name in
+                headers.get("Vary", "").split(",") if name.strip()]
+        public = "public" in cache_control or "s-maxage" in cache_control
+        if _authenticated(request) and not public:
+            return None
+        if "no-store" in cache_control or "*" in vary:
+            self._cache.pop(request.url)
+            return None
+        now = time.time()
+        date = _parse_http_date(headers.get("Date")) or now
+        last_modified = headers.get("Last-Modified")
+        if "no-cache" in cache_control:
+            lifetime = 0
+        elif "max-age" in cache_control:
+            try:
+                lifetime = int(cache_control["max-age"])
+            except (TypeError, ValueError):
+                lifetime = 0
+        elif "Expires" in headers:
+            lifetime = (_parse_http_date(headers["Expires"]) or 0) - date
+        elif last_modified and _parse_http_date(last_modified):
+            lifetime = min(self.MAX_HEURISTIC_LIFETIME,
+                           self.HEURISTIC_FRACTION *
+                           (date - _parse_http_date(last_modified)))
+        else:
+            lifetime = 0
+        try:
+            age = max(0, int(headers.get("Age", 0)))
+        except ValueError:
+            age = 0
+        etag = headers.get("Etag")
+        if lifetime <= 0 and not (etag or last_modified):
+            self._cache.pop(request.url)
+            return None
+        entry = _CacheEntry(
+            headers=headers, body=body, effective_url=effective_url,
+            expires=now - age + lifetime, etag=etag,
+            last_modified=last_modified, public=public,
+            vary=dict((name, _header(request.headers, name))
+                      for name in vary))
+        self._cache[request.url] = entry
+        self.stored += 1
+        return entry
+
+
+class _CacheEntry:
+    """A response stored in an HTTPCache."""
+    def __init__(self, headers, body, effective_url, expires, etag,
+                 last_modified, public, vary):
+        self.headers = headers
+        self.body = body
+        self.effective_url = effective_url
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.public = public
+        self.vary = vary
+
+    def response(self, request, revalidation=None):
+        """Returns an HTTPResponse to request with the stored response.
+
+        If this is the result of a revalidation, the timings are those of
+        the request that revalidated it.
+        """
+        return HTTPResponse(
+            request=request, code=200, headers=dict(self.headers),
+            body=self.body, effective_url=self.effective_url,
+            request_time=revalidation.request_time if revalidation else 0,
+            time_info=revalidation.time_info if revalidation else None)
+
+
+class DNSCache:
+    """Host name lookups shared by the requests on an IOLoop.
+
+    socket.getaddrinfo() blocks, so we run it in a pool of max_workers
+    threads and call back on the IOLoop with the result. Results are kept
+    for ttl seconds, for at most max_entries hosts, and concurrent lookups
+    of the same host share one call. Numeric addresses are converted
+    without a lookup.
+
+        resolver = httpclient.DNSCache()
+        http_client = httpclient.AsyncHTTPClient(resolver=resolver)
+
+    stats() adds the number of lookups made and failed, and the number in
+    progress, to the counters of the underlying LRUCache.
+    """
+    def __init__(self, io_loop=None, ttl=300, max_entries=1024,
+                 max_workers=4):
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.ttl = ttl
+        self.lookups = 0
+        self.failures = 0
+        self._cache = cache.LRUCache(max_entries=max_entries)
+        self._pending = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def resolve(self, host, port, callback):
+        """Looks up host and port, calling callback(addresses, error).
+
+        addresses is a list of getaddrinfo() results for TCP, or None if
+        the lookup failed, in which case error is the socket.error. Cached
+        results are passed to callback before we return.
+        """
+        key = (host, port)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.time():
+            callback(entry[1], None)
+            return
+        try:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM,
+                                           0, socket.AI_NUMERICHOST)
+        except (socket.error, UnicodeError):
+            pass
+        else:
+            callback(addresses, None)
+            return
+        if key in self._pending:
+            self._pending[key].append(callback)
+            return
+        self._pending[key] = [callback]
+        self.lookups += 1
+        future = self._executor.submit(
+            socket.getaddrinfo, host, port, 0, socket.SOCK_STREAM)
+        # Futures call back on the worker thread
+        future.add_done_callback(lambda future: self.io_loop.add_callback(
+            functools.partial(self._on_lookup, key, future)))
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats.update(lookups=self.lookups, failures=self.failures,
+                     pending=len(self._pending))
+        return stats
+
+    def _on_lookup(self, key, future):
+        try:
+            addresses, error = future.result(), None
+        except (socket.error, UnicodeError) as e:
+            addresses, error = None, e
+            self.failures += 1
+        else:
+            self._cache[key] = (time.time() + self.ttl, addresses)
+        for callback in self._pending.pop(key):
+            callback(addresses, error)
+
+
+class RequestCoalescer:
+    """Merges identical GET and HEAD requests that are in flight at once.
+
+    The first request for a given URL, method, headers and options is
+    fetched, and any identical request made before it completes waits for
+    its response instead of being sent. Every waiting callback gets its
+    own copy of the HTTPResponse, with its own request. Requests with a
+    body or a streaming_callback are never merged.
+
+    stats() returns the number of requests in flight, how many requests
+    were fetched, and how many were coalesced into another.
+    """
+    def __init__(self):
+        self._in_flight = {}
+        self.fetched = 0
+        self.coalesced = 0
+
+    def join(self, request, callback):
+        """Returns the callback to fetch request with, or None.
+
+        None means an identical request is in flight and callback will be
+        called with its response.
+        """
+        key = _coalescing_key(request)
+        if key is None:
+            return callback
+        waiting = self._in_flight.get(key)
+        if waiting is not None:
+            waiting.append((request, callback))
+            self.coalesced += 1
+            return None
+        self._in_flight[key] = [(request, callback)]
+        self.fetched += 1
+        return functools.partial(self._on_response, key)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._in_flight),
+            "fetched": self.fetched,
+            "coalesced": self.coalesced,
+        }
+
+    def _on_response(self, key, response):
+        for request, callback in self._in_flight.pop(key):
+            if request is not response.request:
+                response = copy.copy(response)
+                response.request = request
+            callback(response)
+
+
+class RequestQueue:
+    """Requests waiting for a client to start them.
+
+    Requests are kept in a FIFO per host within each priority. pop() takes
+    from the lowest priority value first and, within a priority, from each
+    host in turn, skipping hosts the client cannot start more requests to.
+    stats() returns the current depth, the deepest the queue has been, and
+    the depth per priority and per host.
+    """
+    def __init__(self):
+        # priority -> OrderedDict of host key -> deque, in turn order
+        self._levels = {}
+        self._priorities = []
+        self._depth = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return self._depth
+
+    def append(self, key, priority, item, first=False):
+        """Queues item for the given host key and priority.
+
+        If first is true, the item goes ahead of the host's other requests
+        at that priority (e.g., for a redirect of a request already
+        started).
+        """
+        hosts = self._levels.get(priority)
+        if hosts is None:
+            hosts = self._levels[priority] = collections.OrderedDict()
+            bisect.insort(self._priorities, priority)
+        items = hosts.get(key)
+        if items is None:
+            items = hosts[key] = collections.deque()
+        if first:
+            items.appendleft(item)
+        else:
+            items.append(item)
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+
+    def pop(self, can_start=None):
+        """Returns (key, item) for the next request to start, or None.
+
+        can_start(key) says whether a request to the host may start now.
+        """
+        for priority in self._priorities:
+            hosts = self._levels[priority]
+            for key, items in hosts.items():
+                if can_start is not None and not can_start(key):
+                    continue
+                item = items.popleft()
+                if items:
+                    hosts.move_to_end(key)
+                else:
+                    del hosts[key]
+                    if not hosts:
+                        del self._levels[priority]
+                        self._priorities.remove(priority)
+                self._depth -= 1
+                return key, item
+        return None
+
+    def stats(self):
+        hosts = {}
+        for level in self._levels.values():
+            for key, items in level.items():
+                hosts[key] = hosts.get(key, 0) + len(items)
+        return {
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "priorities": dict(
+                (priority, sum(len(items) for items in level.values()))
+                for priority, level in self._levels.items()),
+            "hosts": hosts,
+        }
+
+
+class _ResponseBuffer:
+    """Accumulates the pieces of a response body as bytes.
+
+    Pieces are kept in a list and joined once at the end. If the response
+    announces its length, expect() preallocates a single buffer for it
+    instead, so a large body is not held as thousands of small objects.
+    """
+    # Larger announced lengths are not trusted enough to preallocate
+    MAX_PREALLOCATE = 64 * 1024 * 1024
+
+    def __init__(self):
+        self._chunks = []
+        self._buffer = None
+        self._size = 0
+
+    def expect(self, length):
+        """Preallocates for a body of the given length if nothing has been
+        written yet."""
+        if not self._size and 0 < length <= self.MAX_PREALLOCATE:
+            self._buffer = bytearray(length)
+
+    def write(self, chunk):
+        size = self._size + len(chunk)
+        if self._buffer is not None:
+            if size <= len(self._buffer):
+                self._buffer[self._size:size] = chunk
+                self._size = size
+                return
+            # The server sent more than it announced
+            self._chunks.append(bytes(self._buffer[:self._size]))
+            self._buffer = None
+        self._chunks.append(chunk)
+        self._size = size
+
+    def getvalue(self):
+        if self._buffer is not None:
+            if self._size < len(self._buffer):
+                del self._buffer[self._size:]
+            return bytes(self._buffer)
+        return b"".join(self._chunks)
+
+
+class _RequestBody:
+    """Reads an HTTPRequest body for curl's READFUNCTION.
+
+    Buffers are read through a memoryview and files are read in place, so
+    the body is never copied as a whole.
+    """
+    def __init__(self, body):
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        if hasattr(body, "read"):
+            self._file = body
+            self._start = body.tell()
+            self.size = body.seek(0, os.SEEK_END) - self._start
+            body.seek(self._start)
+        else:
+            self._file = None
+            self._view = memoryview(body).cast("B")
+            self._position = 0
+            self.size = len(self._view)
+
+    def read(self, size):
+        if self._file is not None:
+            return self._file.read(size)
+        chunk = self._view[self._position:self._position + size]
+        self._position += len(chunk)
+        return bytes(chunk)
+
+    def rewind(self):
+        if self._file is not None:
+            self._file.seek(self._start)
+        else:
+            self._position = 0
+
+
 class HTTPError(Exception):
     def __init__(self, code, message=None):
         self.code = code
@@ -322,92 +1079,226 @@ class CurlError(HTTPError):
         self.errno = errno
 
 
+def _host_key(url):
+    """Returns "host:port" for the given URL."""
+    parsed = urllib.parse.urlsplit(url)
+    return "%s:%s" % (parsed.hostname, parsed.port or
+                      {"https": 443}.get(parsed.scheme, 80))
+
+
+def _header(headers, name):
+    """Returns the value of the named header, ignoring case, or None."""
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _authenticated(request):
+    return bool(request.auth_username) or \
+        _header(request.headers, "Authorization") is not None
+
+
+def _conditional(headers):
+    return _header(headers, "If-None-Match") is not None or \
+        _header(headers, "If-Modified-Since") is not None
+
+
+def _cache_control(headers):
+    """Parses a Cache-Control header into a dict of directives to values.
+
+    Directives without a value (e.g., no-store) map to None. A request's
+    Pragma: no-cache counts as Cache-Control: no-cache.
+    """
+    directives = {}
+    for directive in (_header(headers, "Cache-Control") or "").split(","):
+        name, sep, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"') if sep else None
+    if (_header(headers, "Pragma") or "").strip().lower() == "no-cache":
+        directives.setdefault("no-cache", None)
+    return directives
+
+
+def _parse_http_date(value):
+    """Returns the HTTP date in value as a UTC timestamp, or None."""
+    if not value:
+        return None
+    date_tuple = email.utils.parsedate_tz(value)
+    if date_tuple is None:
+        return None
+    return email.utils.mktime_tz(date_tuple)
+
+
+def _coalescing_key(request):
+    """Returns what identical requests have in common, or None."""
+    if request.method not in ("GET", "HEAD") or request.body is not None or \
+       request.streaming_callback is not None:
+        return None
+    return (request.method, request.url,
+            tuple(sorted(request.headers.items())), request.auth_username,
+            request.auth_password, request.follow_redirects,
+            request.max_redirects, request.user_agent, request.use_gzip,
+            request.network_interface)
+
+
 def _curl_create(max_simultaneous_connections=None):
+    if pycurl is None:
+        raise ImportError("The pycurl module is required for HTTPClient and "
+                          "AsyncHTTPClient; see simple_httpclient")
     curl = pycurl.Curl()
     if logging.getLogger().isEnabledFor(logging.DEBUG):
         curl.setopt(pycurl.VERBOSE, 1)
         curl.setopt(pycurl.DEBUGFUNCTION, _curl_debug)
     curl.setopt(pycurl.MAXCONNECTS, max_simultaneous_connections or 5)
-    return curl
-
-
-def _curl_setup_request(curl, request, buffer, headers):
-    curl.setopt(pycurl.URL, request.url)
-    curl.setopt(pycurl.HTTPHEADER,
-                ["%s: %s" % i for i in request.headers.items()])
+    # The options we have set on this handle, so that each request only
+    # sets the ones that differ from the last (see _curl_setopt)
+    curl.options = {}
+    # The headers and body of the current response. The callbacks look
+    # them up on the handle, so they are only set once.
+    curl.response_headers = None
+    curl.response_buffer = None
+    def header_callback(header_line):
+        _curl_header_callback(curl.response_headers, curl.response_buffer,
+                              header_line)
+    def write_callback(chunk):
+        curl.response_buffer.write(chunk)
+    curl.write_callback = write_callback
     try:
-        curl.setopt(pycurl.HEADERFUNCTION,
-                    functools.partial(_curl_header_callback, headers))
+        curl.setopt(pycurl.HEADERFUNCTION, header_callback)
     except Exception:
         # Old version of curl; response will not include headers
         pass
-    if request.streaming_callback:
-        curl.setopt(pycurl.WRITEFUNCTION, request.streaming_callback)
-    else:
-        curl.setopt(pycurl.WRITEFUNCTION, buffer.write)
-    curl.setopt(pycurl.FOLLOWLOCATION, request.follow_redirects)
-    curl.setopt(pycurl.MAXREDIRS, request.max_redirects)
-    curl.setopt(pycurl.CONNECTTIMEOUT, int(request.connect_timeout))
-    curl.setopt(pycurl.TIMEOUT, int(request.request_timeout))
-    if request.user_agent:
-        curl.setopt(pycurl.USERAGENT, request.user_agent)
-    else:
-        curl.setopt(pycurl.USERAGENT, "Mozilla/5.0 (compatible; pycurl)")
+    return curl
+
+
+def _curl_setopt(curl, option, value):
+    """Sets an option on curl unless it is already set to value."""
+    current = curl.options.get(option, _UNSET)
+    if current is value or (type(current) is type(value) and
+                            current == value):
+        return
+    curl.setopt(option, value)
+    curl.options[option] = value
+
+
+def _curl_unsetopt(curl, option):
+    if curl.options.pop(option, _UNSET) is not _UNSET:
+        curl.unsetopt(option)
+
+
+# Sentinel for options we have not set
+_UNSET = object()
+
+# Curl has an option for some methods, and CUSTOMREQUEST for the rest
+_CURL_METHOD_OPTIONS = {
+    "GET": pycurl.HTTPGET,
+    "POST": pycurl.POST,
+    "PUT": pycurl.UPLOAD,
+    "HEAD": pycurl.NOBODY,
+} if pycurl is not None else {}
+_CURL_CUSTOM_METHODS = frozenset(["DELETE"])
+
+
+def _curl_setup_request(curl, request, buffer, headers, resolve=None):
+    """Prepares curl to fetch request into buffer and headers.
+
+    Handles are reused, so we only set the options that differ from the
+    previous request on the same handle; for a run of similar requests
+    that is usually just the URL. resolve is a list of "host:port:address"
+    entries for CURLOPT_RESOLVE.
+    """
+    curl.response_headers = headers
+    curl.response_buffer = buffer
+    curl.setopt(pycurl.URL, request.url)
+    if resolve:
+        # Always set, since curl forgets the entries after its own DNS
+        # cache timeout
+        curl.setopt(pycurl.RESOLVE, resolve)
+    _curl_setopt(curl, pycurl.HTTPHEADER,
+                 ["%s: %s" % i for i in request.headers.items()])
+    _curl_setopt(curl, pycurl.WRITEFUNCTION,
+                 request.streaming_callback or curl.write_callback)
+    _curl_setopt(curl, pycurl.FOLLOWLOCATION, request.follow_redirects)
+    _curl_setopt(curl, pycurl.MAXREDIRS, request.max_redirects)
+    _curl_setopt(curl, pycurl.CONNECTTIMEOUT, int(request.connect_timeout))
+    _curl_setopt(curl, pycurl.TIMEOUT, int(request.request_timeout))
+    _curl_setopt(curl, pycurl.USERAGENT,
+                 request.user_agent or "Mozilla/5.0 (compatible; pycurl)")
     if request.network_interface:
-        curl.setopt(pycurl.INTERFACE, request.network_interface)
-    if request.use_gzip:
-        curl.setopt(pycurl.ENCODING, "gzip,deflate")
+        _curl_setopt(curl, pycurl.INTERFACE, request.network_interface)
     else:
-        curl.setopt(pycurl.ENCODING, "none")
+        _curl_unsetopt(curl, pycurl.INTERFACE)
+    _curl_setopt(curl, pycurl.ENCODING,
+                 "gzip,deflate" if request.use_gzip else "none")
 
     # Set the request method through curl's retarded interface which makes
-    # up names for almost every single method
-    curl_options = {
-        "GET": pycurl.HTTPGET,
-        "POST": pycurl.POST,
-        "PUT": pycurl.UPLOAD,
-        "HEAD": pycurl.NOBODY,
-    }
-    custom_methods = set(["DELETE"])
-    for o in list(curl_options.values()):
-        curl.setopt(o, False)
-    if request.method in curl_options:
-        curl.unsetopt(pycurl.CUSTOMREQUEST)
-        curl.setopt(curl_options[request.method], True)
-    elif request.method in custom_methods:
-        curl.setopt(pycurl.CUSTOMREQUEST, request.method)
-    else:
+    # up names for almost every single method. Clear the old method's
+    # option before setting the new one.
+    if request.method not in _CURL_METHOD_OPTIONS and \
+       request.method not in _CURL_CUSTOM_METHODS:
         raise KeyError('unknown method ' + request.method)
+    method_option = _CURL_METHOD_OPTIONS.get(request.method)
+    for option in _CURL_METHOD_OPTIONS.values():
+        if option != method_option:
+            _curl_setopt(curl, option, False)
+    if method_option is not None:
+        _curl_unsetopt(curl, pycurl.CUSTOMREQUEST)
+        _curl_setopt(curl, method_option, True)
+    else:
+        _curl_setopt(curl, pycurl.CUSTOMREQUEST, request.method)
 
     # Handle curl's cryptic options for every individual HTTP method
     if request.method in ("POST", "PUT"):
-        request_buffer =  io.StringIO(request.body)
-        curl.setopt(pycurl.READFUNCTION, request_buffer.read)
+        request_body = _RequestBody(request.body or b"")
+        curl.setopt(pycurl.READFUNCTION, request_body.read)
         if request.method == "POST":
             def ioctl(cmd):
                 if cmd == curl.IOCMD_RESTARTREAD:
-                    request_buffer.seek(0)
+                    request_body.rewind()
             curl.setopt(pycurl.IOCTLFUNCTION, ioctl)
-            curl.setopt(pycurl.POSTFIELDSIZE, len(request.body))
+            _curl_setopt(curl, pycurl.POSTFIELDSIZE, request_body.size)
         else:
-            curl.setopt(pycurl.INFILESIZE, len(request.body))
+            _curl_setopt(curl, pycurl.INFILESIZE, request_body.size)
 
     if request.auth_username and request.auth_password:
         userpwd = "%s:%s" % (request.auth_username, request.auth_password)
-        curl.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
-        curl.setopt(pycurl.USERPWD, userpwd)
+        _curl_setopt(curl, pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+        _curl_setopt(curl, pycurl.USERPWD, userpwd)
         logging.info("%s %s (username: %r)", request.method, request.url,
                      request.auth_username)
     else:
-        curl.unsetopt(pycurl.USERPWD)
+        _curl_unsetopt(curl, pycurl.USERPWD)
         logging.info("%s %s", request.method, request.url)
 
 
-def _curl_header_callback(headers, header_line):
+def _curl_release(curl):
+    """Drops curl's references to the last response."""
+    curl.response_headers = None
+    curl.response_buffer = None
+
+
+def _curl_time_info(curl):
+    return {
+        "namelookup": curl.getinfo(pycurl.NAMELOOKUP_TIME),
+        "connect": curl.getinfo(pycurl.CONNECT_TIME),
+        "appconnect": curl.getinfo(pycurl.APPCONNECT_TIME),
+        "pretransfer": curl.getinfo(pycurl.PRETRANSFER_TIME),
+        "starttransfer": curl.getinfo(pycurl.STARTTRANSFER_TIME),
+        "total": curl.getinfo(pycurl.TOTAL_TIME),
+    }
+
+
+def _curl_header_callback(headers, buffer, header_line):
+    # Header values are only guaranteed to be ASCII, and latin-1 decodes
+    # anything else without losing it
+    header_line = header_line.decode("latin1")
     if header_line.startswith("HTTP/"):
         headers.clear()
         return
     if header_line == "\r\n":
+        _expect_body(headers, buffer)
         return
     parts = header_line.split(": ")
     if len(parts) != 2:
@@ -416,6 +1307,21 @@ def _curl_header_callback(headers, header_line):
     headers[parts[0].strip()] = parts[1].strip()
 
 
+def _expect_body(headers, buffer):
+    """Tells the body buffer the length of the response, if it is known.
+
+    curl decodes compressed responses, so their Content-Length is not the
+    length of the body it writes.
+    """
+    length = _header(headers, "Content-Length")
+    if length is None or _header(headers, "Content-Encoding") is not None:
+        return
+    try:
+        buffer.expect(int(length))
+    except ValueError:
+        pass
+
+
 def _curl_debug(debug_type, debug_msg):
     debug_types = ('I', '<', '>', '<', '>')
     if debug_type == 0:
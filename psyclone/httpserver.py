@@ -20,6 +20,7 @@
 import errno
 import fcntl
 import functools
+import gc
 from . import ioloop
 from . import iostream
 import logging
@@ -174,6 +175,12 @@ class HTTPServer:
             num_processes = 1
         if num_processes > 1:
             logging.info("Pre-forking %d server processes", num_processes)
+            # Keep the garbage collector in the children away from objects
+            # created before the fork (e.g., preloaded templates). Otherwise
+            # every collection writes to their pages and undoes the sharing
+            # copy-on-write gives us.
+            if hasattr(gc, "freeze"):
+                gc.freeze()
             for i in range(num_processes):
                 if os.fork() == 0:
                     ioloop.IOLoop.instance().add_handler(
@@ -227,6 +234,14 @@ class HTTPConnection:
         if not self.stream.closed():
             self.stream.write(chunk, self._on_write_complete)
 
+    def write_file(self, file, offset=0, count=None):
+        assert self._request, "Request closed"
+        if not self.stream.closed():
+            self.stream.write_file(file, offset, count,
+                                   self._on_write_complete)
+        else:
+            file.close()
+
     def finish(self):
         assert self._request, "Request closed"
         self._request_finished = True
@@ -385,10 +400,22 @@ class HTTPRequest:
         return self.version == "HTTP/1.1"
 
     def write(self, chunk):
-        """Writes the given chunk to the response stream."""
-        assert isinstance(chunk, bytes)
+        """Writes the given chunk to the response stream.
+
+        chunk may be bytes or a list of bytes objects, which are written in
+        order without being joined (see IOStream.write).
+        """
+        assert isinstance(chunk, (bytes, list))
         self.connection.write(chunk)
 
+    def write_file(self, file, offset=0, count=None):
+        """Writes count bytes of the given file to the response stream.
+
+        The connection takes ownership of the file and closes it when done.
+        See IOStream.write_file.
+        """
+        self.connection.write_file(file, offset, count)
+
     def finish(self):
         """Finishes this HTTP request on the open connection."""
         self.connection.finish()
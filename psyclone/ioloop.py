@@ -96,7 +96,7 @@ class IOLoop:
         self._set_nonblocking(w)
         self._waker_reader = os.fdopen(r, "rb", 0)
         self._waker_writer = os.fdopen(w, "wb", 0)
-        self.add_handler(r, self._read_waker, self.WRITE)
+        self.add_handler(r, self._read_waker, self.READ)
 
     @classmethod
     def instance(cls):
@@ -250,7 +250,7 @@ class IOLoop:
 
     def _wake(self):
         try:
-            self._waker_writer.write("x")
+            self._waker_writer.write(b"x")
         except IOError:
             pass
 
@@ -261,9 +261,10 @@ class IOLoop:
             logging.error("Exception in callback %r", callback, exc_info=True)
 
     def _read_waker(self, fd, events):
+        # The pipe is non-blocking, so read() returns None once it is empty
         try:
-            while True:
-                self._waker_reader.read()
+            while self._waker_reader.read():
+                pass
         except IOError:
             pass
 
@@ -17,10 +17,13 @@
 
 """A utility class to write to and read from a non-blocking socket."""
 
+import collections
 import errno
 from . import ioloop
 import logging
+import os
 import socket
+import ssl
 
 
 class IOStream:
@@ -59,29 +62,68 @@ class IOStream:
         stream.read_until("\r\n\r\n", on_headers)
         ioloop.IOLoop.instance().start()
 
+    Files can be written with write_file(), which uses os.sendfile() to copy
+    them straight from the page cache to the socket where it is available.
+
+    Data read from the stream is decoded with the given encoding (UTF-8 by
+    default); pass encoding=None to read bytes. Client sockets can be
+    connected without blocking with connect().
     """
+    # The most we send from a file in one system call
+    FILE_CHUNK_SIZE = 1024 * 1024
+    # The most buffers we pass to one sendmsg() call
+    MAX_IOVECS = 64
+
     def __init__(self, socket, io_loop=None, max_buffer_size=104857600,
-                 read_chunk_size=4096):
+                 read_chunk_size=4096, encoding="utf8"):
         self.socket = socket
         self.socket.setblocking(False)
         self.io_loop = io_loop or ioloop.IOLoop.instance()
         self.max_buffer_size = max_buffer_size
         self.read_chunk_size = read_chunk_size
-        self._read_buffer = b""
-        self._write_buffer = b""
+        self.encoding = encoding
+        self._read_buffer = bytearray()
+        self._write_queue = collections.deque()
+        plain = not isinstance(socket, ssl.SSLSocket)
+        self._sendfile = plain and hasattr(os, "sendfile")
+        self._sendmsg = plain and hasattr(socket, "sendmsg")
         self._read_delimiter = None
         self._read_bytes = None
+        self._read_until_close = False
         self._read_callback = None
         self._write_callback = None
         self._close_callback = None
+        self._connect_callback = None
+        self._connecting = False
         self._state = self.io_loop.ERROR
         self.io_loop.add_handler(
             self.socket.fileno(), self._handle_events, self._state)
 
+    def connect(self, address, callback=None):
+        """Connects the socket to a remote address without blocking.
+
+        address is passed to socket.connect(), and callback is called once
+        the connection is established. If the connection fails, the stream
+        is closed. Data may be written before the connection is established.
+        """
+        self._connecting = True
+        try:
+            self.socket.connect(address)
+        except socket.error as e:
+            if e.errno not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                logging.warning("Connect error on %d: %s",
+                                self.socket.fileno(), e)
+                self.close()
+                return
+        self._connect_callback = callback
+        self._add_io_state(self.io_loop.WRITE)
+
     def read_until(self, delimiter, callback):
         """Call callback when we read the given delimiter."""
         assert not self._read_callback, "Already reading"
-        loc = self._read_buffer.find(bytes(delimiter, "utf8"))
+        if isinstance(delimiter, str):
+            delimiter = delimiter.encode("utf8")
+        loc = self._read_buffer.find(delimiter)
         if loc != -1:
             callback(self._consume(loc + len(delimiter)))
             return
@@ -101,16 +143,50 @@ class IOStream:
         self._read_callback = callback
         self._add_io_state(self.io_loop.READ)
 
+    def read_until_close(self, callback):
+        """Call callback with all the data read until the stream is closed."""
+        assert not self._read_callback, "Already reading"
+        if self.closed():
+            callback(self._consume(len(self._read_buffer)))
+            return
+        self._read_until_close = True
+        self._read_callback = callback
+        self._add_io_state(self.io_loop.READ)
+
     def write(self, data, callback=None):
         """Write the given data to this stream.
 
+        data may be a bytes-like object or a list of them. The buffers in a
+        list are written in order with a single sendmsg() call where
+        possible, so callers can frame a large payload without copying it.
+
         If callback is given, we call it when all of the buffered write
         data has been successfully written to the stream. If there was
         previously buffered write data and an old write callback, that
         callback is simply overwritten with this new callback.
         """
         self._check_closed()
-        self._write_buffer += data
+        if isinstance(data, list):
+            self._write_queue.extend(buffer for buffer in data if buffer)
+        elif data:
+            self._write_queue.append(data)
+        self._add_io_state(self.io_loop.WRITE)
+        self._write_callback = callback
+
+    def write_file(self, file, offset=0, count=None, callback=None):
+        """Write count bytes of file, starting at offset, to this stream.
+
+        The file is written after any data already queued with write(), and
+        before anything written after this call. We take ownership of the
+        file and close it once it has been written (or the stream closes).
+        If count is None, we write everything from offset to the end of the
+        file; a count of 0 writes nothing. callback behaves as it does for
+        write().
+        """
+        self._check_closed()
+        if count is None:
+            count = max(0, os.fstat(file.fileno()).st_size - offset)
+        self._write_queue.append(_FileWrite(file, offset, count))
         self._add_io_state(self.io_loop.WRITE)
         self._write_callback = callback
 
@@ -124,6 +200,15 @@ class IOStream:
             self.io_loop.remove_handler(self.socket.fileno())
             self.socket.close()
             self.socket = None
+            for item in self._write_queue:
+                if isinstance(item, _FileWrite):
+                    item.file.close()
+            self._write_queue.clear()
+            if self._read_until_close:
+                callback = self._read_callback
+                self._read_callback = None
+                self._read_until_close = False
+                callback(self._consume(len(self._read_buffer)))
             if self._close_callback: self._close_callback()
 
     def reading(self):
@@ -132,7 +217,7 @@ class IOStream:
 
     def writing(self):
         """Returns true if we are currently writing to the stream."""
-        return len(self._write_buffer) > 0
+        return len(self._write_queue) > 0
 
     def closed(self):
         return self.socket is None
@@ -146,6 +231,10 @@ class IOStream:
         if not self.socket:
             return
         if events & self.io_loop.WRITE:
+            if self._connecting:
+                self._handle_connect()
+                if not self.socket:
+                    return
             self._handle_write()
         if not self.socket:
             return
@@ -153,9 +242,9 @@ class IOStream:
             self.close()
             return
         state = self.io_loop.ERROR
-        if self._read_delimiter or self._read_bytes:
+        if self._read_delimiter or self._read_bytes or self._read_until_close:
             state |= self.io_loop.READ
-        if self._write_buffer:
+        if self._write_queue or self._connecting:
             state |= self.io_loop.WRITE
         if state != self._state:
             self._state = state
@@ -165,7 +254,7 @@ class IOStream:
         try:
             chunk = self.socket.recv(self.read_chunk_size)
         except socket.error as e:
-            if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+            if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return
             else:
                 logging.warning("Read error on %d: %s",
@@ -180,6 +269,8 @@ class IOStream:
             logging.error("Reached maximum read buffer size")
             self.close()
             return
+        if self._read_until_close:
+            return
         if self._read_bytes:
             if len(self._read_buffer) >= self._read_bytes:
                 num_bytes = self._read_bytes
@@ -188,7 +279,7 @@ class IOStream:
                 self._read_bytes = None
                 callback(self._consume(num_bytes))
         elif self._read_delimiter:
-            loc = self._read_buffer.find(bytes(self._read_delimiter, 'utf8'))
+            loc = self._read_buffer.find(self._read_delimiter)
             if loc != -1:
                 callback = self._read_callback
                 delimiter_len = len(self._read_delimiter)
@@ -196,28 +287,95 @@ class IOStream:
                 self._read_delimiter = None
                 callback(self._consume(loc + delimiter_len))
 
+    def _handle_connect(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logging.warning("Connect error on %d: %s", self.socket.fileno(),
+                            os.strerror(err))
+            self.close()
+            return
+        self._connecting = False
+        if self._connect_callback is not None:
+            callback = self._connect_callback
+            self._connect_callback = None
+            callback()
+
     def _handle_write(self):
-        while self._write_buffer:
+        queue = self._write_queue
+        while queue:
             try:
-                num_bytes = self.socket.send(self._write_buffer)
-                self._write_buffer = self._write_buffer[num_bytes:]
+                if isinstance(queue[0], _FileWrite):
+                    # Empty ranges are complete without sending anything
+                    if queue[0].remaining and \
+                       not self._write_file_chunk(queue[0]):
+                        return
+                    if not queue[0].remaining:
+                        queue.popleft().file.close()
+                    continue
+                # Send consecutive buffers with a single call
+                buffers = []
+                for item in queue:
+                    if isinstance(item, _FileWrite) or \
+                       len(buffers) == self.MAX_IOVECS:
+                        break
+                    buffers.append(item)
+                if self._sendmsg:
+                    num_bytes = self.socket.sendmsg(buffers)
+                else:
+                    if len(buffers) > 1:
+                        for i in range(len(buffers)):
+                            queue.popleft()
+                        queue.appendleft(b"".join(buffers))
+                    num_bytes = self.socket.send(queue[0])
+                while num_bytes:
+                    size = len(queue[0])
+                    if num_bytes < size:
+                        queue[0] = memoryview(queue[0])[num_bytes:]
+                        break
+                    queue.popleft()
+                    num_bytes -= size
             except socket.error as e:
-                if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
                     break
                 else:
                     logging.warning("Write error on %d: %s",
                                     self.socket.fileno(), e)
                     self.close()
                     return
-        if not self._write_buffer and self._write_callback:
+        if not queue and self._write_callback:
             callback = self._write_callback
             self._write_callback = None
             callback()
 
+    def _write_file_chunk(self, item):
+        """Sends the next piece of a queued file.
+
+        Returns False if the stream was closed because the file turned out
+        to be shorter than promised.
+        """
+        count = min(item.remaining, self.FILE_CHUNK_SIZE)
+        if self._sendfile:
+            num_bytes = os.sendfile(self.socket.fileno(), item.file.fileno(),
+                                    item.offset, count)
+        else:
+            item.file.seek(item.offset)
+            data = item.file.read(count)
+            num_bytes = self.socket.send(data) if data else 0
+        if not num_bytes:
+            logging.warning("File ended early while writing to %d",
+                            self.socket.fileno())
+            self.close()
+            return False
+        item.offset += num_bytes
+        item.remaining -= num_bytes
+        return True
+
     def _consume(self, loc):
-        result = str(self._read_buffer[:loc], 'utf8')
-        self._read_buffer = self._read_buffer[loc:]
-        return result
+        result = bytes(self._read_buffer[:loc])
+        del self._read_buffer[:loc]
+        if self.encoding is None:
+            return result
+        return str(result, self.encoding)
 
     def _check_closed(self):
         if not self.socket:
@@ -227,3 +385,11 @@ class IOStream:
         if not self._state & state:
             self._state = self._state | state
             self.io_loop.update_handler(self.socket.fileno(), self._state)
+
+
+class _FileWrite:
+    """A range of a file queued to be written to an IOStream."""
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.remaining = count
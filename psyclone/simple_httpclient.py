@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Dusty Phillips
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A non-blocking HTTP client built on IOStream, without pycurl.
+
+SimpleAsyncHTTPClient has the same interface as httpclient.AsyncHTTPClient
+and returns the same HTTPResponse objects, with the body as bytes:
+
+    def handle_response(response):
+        if response.error:
+            print "Error:", response.error
+        else:
+            print response.body
+        ioloop.IOLoop.instance().stop()
+
+    http_client = simple_httpclient.SimpleAsyncHTTPClient()
+    http_client.fetch("http://www.google.com/", handle_response)
+    ioloop.IOLoop.instance().start()
+
+Connections are kept open after each response (HTTP/1.1 keep-alive) in a
+ConnectionPool and reused by later requests to the same host and port.
+Only http URLs are supported; use httpclient.AsyncHTTPClient for https.
+"""
+
+import base64
+import collections
+import copy
+import errno
+import functools
+import io
+from . import httpclient
+from . import httpserver
+from . import ioloop
+from . import iostream
+import os
+import re
+import socket
+import time
+import urllib.parse
+import zlib
+
+
+class SimpleAsyncHTTPClient:
+    """A non-blocking HTTP client that reuses connections.
+
+    There is one client per IOLoop. At most max_clients requests run at
+    once, and at most max_per_host of them to any one host and port; the
+    rest wait in an httpclient.RequestQueue, which starts them by priority
+    and takes turns between hosts. Up to max_idle_connections idle
+    connections are kept for reuse, for at most idle_timeout seconds each
+    (see ConnectionPool).
+
+    Responses have the same time_info as those from AsyncHTTPClient, and
+    the timing attribute (an httpclient.TimingStats) aggregates them by
+    host. Requests on reused connections have namelookup and connect
+    times of zero. As with AsyncHTTPClient, cache may be an
+    httpclient.HTTPCache, and coalesce=True merges identical GET and HEAD
+    requests in flight at the same time.
+
+    Host names are looked up in resolver, an httpclient.DNSCache (we make
+    one if it is not given), so lookups never block the IOLoop.
+    """
+    _ASYNC_CLIENTS = {}
+
+    def __new__(cls, io_loop=None, max_clients=10, max_per_host=4,
+                max_idle_connections=64, idle_timeout=60, cache=None,
+                coalesce=False, resolver=None):
+        io_loop = io_loop or ioloop.IOLoop.instance()
+        if id(io_loop) in cls._ASYNC_CLIENTS:
+            return cls._ASYNC_CLIENTS[id(io_loop)]
+        else:
+            instance = super().__new__(cls)
+            instance.io_loop = io_loop
+            instance.max_clients = max_clients
+            instance.max_per_host = max_per_host
+            instance.pool = ConnectionPool(io_loop, max_idle_connections,
+                                           idle_timeout)
+            instance.queue = httpclient.RequestQueue()
+            instance._active = {}
+            instance._num_active = 0
+            instance.timing = httpclient.TimingStats()
+            instance.cache = cache
+            instance.resolver = resolver or httpclient.DNSCache(io_loop)
+            instance.coalescer = httpclient.RequestCoalescer() \
+                if coalesce else None
+            cls._ASYNC_CLIENTS[id(io_loop)] = instance
+            return instance
+
+    def fetch(self, request, callback, **kwargs):
+        """Executes an HTTPRequest, calling callback with an HTTPResponse.
+
+        If an error occurs during the fetch, the HTTPResponse given to the
+        callback has a non-None error attribute that contains the exception
+        encountered during the request.
+        """
+        if not isinstance(request, httpclient.HTTPRequest):
+           request = httpclient.HTTPRequest(url=request, **kwargs)
+        if self.cache is not None:
+            response = self.cache.get(request)
+            if response is not None:
+                self.io_loop.add_callback(functools.partial(
+                    callback, response))
+                return
+        if self.coalescer is not None:
+            callback = self.coalescer.join(request, callback)
+            if callback is None:
+                return
+        if self.cache is not None:
+            request, callback = self.cache.wrap(request, callback)
+        self.queue.append(_connection_key(request.url), request.priority,
+                          (request, callback, time.time()))
+        self._process_queue()
+
+    def fetch_many(self, requests, callback_per_response, on_done=None,
+                   concurrency=10):
+        """Fetches requests, at most concurrency at a time.
+
+        This works as httpclient.AsyncHTTPClient.fetch_many() does.
+        """
+        httpclient._BatchFetch(self.fetch, requests, callback_per_response,
+                               on_done, concurrency).start()
+
+    def _process_queue(self):
+        while self.queue and self._num_active < self.max_clients:
+            entry = self.queue.pop(self._can_start)
+            if entry is None:
+                # Every queued host is at its max_per_host limit
+                break
+            key, (request, callback, queue_start_time) = entry
+            self._num_active += 1
+            self._active[key] = self._active.get(key, 0) + 1
+            _HTTPConnection(self, key, request, functools.partial(
+                self._on_response, key, callback), queue_start_time)
+
+    def _can_start(self, key):
+        return self._active.get(key, 0) < self.max_per_host
+
+    def _on_response(self, key, callback, response):
+        self._num_active -= 1
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+        self.timing.add(response.request.url, response.time_info)
+        redirect = _redirect_request(response)
+        if redirect is not None:
+            self.queue.append(
+                _connection_key(redirect.url), redirect.priority,
+                (redirect, functools.partial(self._on_redirect,
+                                             response.request, callback),
+                 time.time()), first=True)
+        self._process_queue()
+        if redirect is None:
+            callback(response)
+
+    def _on_redirect(self, original_request, callback, response):
+        response.request = original_request
+        callback(response)
+
+
+class ConnectionPool:
+    """Idle keep-alive connections, keyed by (scheme, host, port).
+
+    At most max_idle connections are kept in total; when there are more, we
+    close the least recently used one. Connections idle for more than
+    idle_timeout seconds are closed, and connections the server has closed
+    are discarded when they are next asked for. stats() returns the number
+    of connections reused (hits), opened (misses) and evicted.
+    """
+    def __init__(self, io_loop, max_idle=64, idle_timeout=60):
+        self.io_loop = io_loop
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._idle = collections.OrderedDict()
+        self._by_key = {}
+        self._expire_timeout = None
+
+    def get(self, key):
+        """Returns an open idle connection to key, or None."""
+        streams = self._by_key.get(key)
+        deadline = time.time() - self.idle_timeout
+        while streams:
+            stream = streams[-1]
+            stream_key, idle_since = self._remove(stream)
+            if idle_since > deadline and _is_alive(stream):
+                self.hits += 1
+                return stream
+            stream.close()
+        self.misses += 1
+        return None
+
+    def put(self, key, stream):
+        """Adds an idle connection to the pool."""
+        self._idle[stream] = (key, time.time())
+        self._by_key.setdefault(key, []).append(stream)
+        while len(self._idle) > self.max_idle:
+            evicted = next(iter(self._idle))
+            self._remove(evicted)
+            evicted.close()
+            self.evictions += 1
+        if self._expire_timeout is None:
+            self._expire_timeout = self.io_loop.add_timeout(
+                time.time() + self.idle_timeout, self._expire)
+
+    def stats(self):
+        return {
+            "idle": len(self._idle),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, stream):
+        key, idle_since = self._idle.pop(stream)
+        streams = self._by_key[key]
+        streams.remove(stream)
+        if not streams:
+            del self._by_key[key]
+        return key, idle_since
+
+    def _expire(self):
+        self._expire_timeout = None
+        deadline = time.time() - self.idle_timeout
+        while self._idle:
+            stream, (key, idle_since) = next(iter(self._idle.items()))
+            if idle_since > deadline:
+                self._expire_timeout = self.io_loop.add_timeout(
+                    idle_since + self.idle_timeout, self._expire)
+                break
+            self._remove(stream)
+            stream.close()
+
+
+class _HTTPConnection:
+    """Runs a single request on a new or pooled connection."""
+    def __init__(self, client, key, request, callback, queue_start_time):
+        self.client = client
+        self.io_loop = client.io_loop
+        self.key = key
+        self.request = request
+        self.callback = callback
+        self.start_time = time.time()
+        self.time_info = {"queue": self.start_time - queue_start_time,
+                          "namelookup": 0.0, "connect": 0.0,
+                          "appconnect": 0.0}
+        self.stream = None
+        self.reused = False
+        self.code = None
+        self.headers = None
+        self.chunks = []
+        self._keep_alive = False
+        self._decompressor = None
+        self._connect_timeout = None
+        # File bodies are sent from where they were when we were created,
+        # even if we have to send them again on a new connection
+        if hasattr(request.body, "read"):
+            self._body_offset = request.body.tell()
+        self._timeout = self.io_loop.add_timeout(
+            self.start_time + request.request_timeout,
+            self._on_request_timeout)
+        scheme, host, port = key
+        if scheme != "http":
+            self.io_loop.add_callback(functools.partial(
+                self._finish_error, "Unsupported URL scheme %r" % scheme))
+            return
+        stream = client.pool.get(key)
+        if stream is not None:
+            self.reused = True
+            self._on_connect(stream)
+        else:
+            self._connect()
+
+    def _connect(self):
+        scheme, host, port = self.key
+        self.client.resolver.resolve(host, port, self._on_resolved)
+
+    def _on_resolved(self, addrinfo, error):
+        if self.callback is None:
+            # We timed out while resolving
+            return
+        if error is not None:
+            scheme, host, port = self.key
+            self._finish_error("Could not resolve %s: %s" % (host, error))
+            return
+        self.time_info["namelookup"] = time.time() - self.start_time
+        family, socktype, proto, canonname, address = addrinfo[0]
+        stream = iostream.IOStream(
+            socket.socket(family, socktype, proto), io_loop=self.io_loop,
+            read_chunk_size=65536, encoding=None)
+        self.stream = stream
+        self._connect_timeout = self.io_loop.add_timeout(
+            time.time() + self.request.connect_timeout,
+            self._on_connect_timeout)
+        stream.set_close_callback(self._on_close)
+        stream.connect(address, functools.partial(self._on_connect, stream))
+
+    def _on_connect(self, stream):
+        if self._connect_timeout is not None:
+            self.io_loop.remove_timeout(self._connect_timeout)
+            self._connect_timeout = None
+            self.time_info["connect"] = time.time() - self.start_time
+        self.stream = stream
+        stream.set_close_callback(self._on_close)
+        request = self.request
+        parsed = urllib.parse.urlsplit(request.url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        scheme, host, port = self.key
+        headers = httpserver.HTTPHeaders()
+        headers["Host"] = host if port == 80 else "%s:%d" % (host, port)
+        headers["User-Agent"] = request.user_agent or \
+            "Mozilla/5.0 (compatible; psyclone)"
+        if request.use_gzip:
+            headers["Accept-Encoding"] = "gzip"
+        if request.auth_username and request.auth_password:
+            credentials = "%s:%s" % (request.auth_username,
+                                     request.auth_password)
+            headers["Authorization"] = "Basic " + base64.b64encode(
+                credentials.encode("utf8")).decode("ascii")
+        for name, value in request.headers.items():
+            # Empty values (e.g., the default Pragma) are for curl's benefit
+            if value:
+                headers[name] = value
+        body, body_file, body_size = self._request_body()
+        if body_size or request.method in ("POST", "PUT"):
+            headers["Content-Length"] = str(body_size)
+        lines = ["%s %s HTTP/1.1" % (request.method, path)]
+        lines.extend("%s: %s" % item for item in headers.items())
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode("utf8")
+        self.time_info["pretransfer"] = time.time() - self.start_time
+        stream.write([data, body] if body else data)
+        if body_file is not None:
+            stream.write_file(body_file, self._body_offset, body_size)
+        stream.read_until(b"\r\n\r\n", self._on_headers)
+
+    def _request_body(self):
+        """Returns the request body as (buffer, file, size).
+
+        Buffers are sent as they are, and files with a descriptor are sent
+        with IOStream.write_file() from a duplicate of that descriptor (which
+        the stream closes), so neither is copied into memory first.
+        """
+        body = self.request.body
+        if body is None:
+            return None, None, 0
+        if hasattr(body, "read"):
+            try:
+                fileno = body.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                body.seek(self._body_offset)
+                body = body.read()
+            else:
+                size = max(0, os.fstat(fileno).st_size - self._body_offset)
+                if not size:
+                    return None, None, 0
+                return None, os.fdopen(os.dup(fileno), "rb"), size
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        body = memoryview(body).cast("B")
+        return body, None, len(body)
+
+    def _on_headers(self, data):
+        self.time_info.setdefault("starttransfer",
+                                  time.time() - self.start_time)
+        first_line, sep, header_data = data.decode("latin1").partition("\r\n")
+        match = re.match(r"HTTP/1\.([01]) (\d{3})", first_line)
+        if not match:
+            self._finish_error("Malformed HTTP response %r" % first_line)
+            return
+        version, code = match.group(1), int(match.group(2))
+        headers = httpserver.HTTPHeaders()
+        for line in header_data.split("\r\n"):
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip()] = value.strip()
+        if 100 <= code < 200:
+            # Skip informational responses like 100 Continue
+            self.stream.read_until(b"\r\n\r\n", self._on_headers)
+            return
+        self.code = code
+        self.headers = headers
+        connection = headers.get("Connection", "").lower()
+        self._keep_alive = connection == "keep-alive" or \
+            (version == "1" and connection != "close")
+        if self.request.use_gzip and \
+           headers.get("Content-Encoding", "").lower() == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.request.method == "HEAD" or code in (204, 304):
+            self._on_body(b"")
+        elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self.stream.read_until(b"\r\n", self._on_chunk_length)
+        elif "Content-Length" in headers:
+            try:
+                length = int(headers["Content-Length"])
+            except ValueError:
+                self._finish_error("Invalid Content-Length %r" %
+                                   headers["Content-Length"])
+                return
+            self.stream.read_bytes(length, self._on_body)
+        else:
+            # The body runs until the server closes the connection
+            self._keep_alive = False
+            self.stream.read_until_close(self._on_body)
+
+    def _on_chunk_length(self, data):
+        try:
+            length = int(data.split(b";")[0].strip(), 16)
+        except ValueError:
+            self._finish_error("Invalid chunk length %r" % data)
+            return
+        if length == 0:
+            self.stream.read_until(b"\r\n", self._on_trailer)
+        else:
+            self.stream.read_bytes(length + 2, self._on_chunk_data)
+
+    def _on_chunk_data(self, data):
+        self._data_received(data[:-2])
+        self.stream.read_until(b"\r\n", self._on_chunk_length)
+
+    def _on_trailer(self, data):
+        if data == b"\r\n":
+            self._on_body(b"")
+        else:
+            self.stream.read_until(b"\r\n", self._on_trailer)
+
+    def _data_received(self, data):
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        if not data:
+            return
+        if self.request.streaming_callback:
+            self.request.streaming_callback(data)
+        else:
+            self.chunks.append(data)
+
+    def _on_body(self, data):
+        self._data_received(data)
+        if self._decompressor is not None:
+            tail = self._decompressor.flush()
+            self._decompressor = None
+            self._data_received(tail)
+        self._finish(httpclient.HTTPResponse(
+            request=self.request, code=self.code, headers=self.headers,
+            body=b"".join(self.chunks), effective_url=self.request.url,
+            request_time=time.time() - self.start_time,
+            time_info=self._time_info()))
+
+    def _on_connect_timeout(self):
+        self._connect_timeout = None
+        self._finish_error("Connect timeout")
+
+    def _on_request_timeout(self):
+        self._timeout = None
+        self._finish_error("Timeout")
+
+    def _on_close(self):
+        if self.callback is None:
+            return
+        if self.reused and self.code is None and \
+           self.request.method in ("GET", "HEAD", "PUT", "DELETE"):
+            # The server closed the pooled connection before we used it, so
+            # try again on a new one
+            self.reused = False
+            self.stream = None
+            self._connect()
+            return
+        self._finish_error("Connection closed")
+
+    def _finish_error(self, message):
+        self._keep_alive = False
+        self._finish(httpclient.HTTPResponse(
+            request=self.request, code=599,
+            error=httpclient.HTTPError(599, message),
+            request_time=time.time() - self.start_time,
+            time_info=self._time_info()))
+
+    def _time_info(self):
+        self.time_info["total"] = time.time() - self.start_time
+        return self.time_info
+
+    def _finish(self, response):
+        if self.callback is None:
+            return
+        for timeout in (self._timeout, self._connect_timeout):
+            if timeout is not None:
+                self.io_loop.remove_timeout(timeout)
+        self._timeout = self._connect_timeout = None
+        stream, self.stream = self.stream, None
+        if stream is not None:
+            stream.set_close_callback(None)
+            if self._keep_alive and not stream.closed():
+                self.client.pool.put(self.key, stream)
+            else:
+                stream.close()
+        callback, self.callback = self.callback, None
+        callback(response)
+
+
+def _connection_key(url):
+    parsed = urllib.parse.urlsplit(url)
+    scheme = parsed.scheme.lower()
+    port = parsed.port or {"http": 80, "https": 443}.get(scheme)
+    return (scheme, parsed.hostname, port)
+
+
+def _redirect_request(response):
+    """Returns the request to make to follow a redirect, or None."""
+    request = response.request
+    if not request.follow_redirects or request.max_redirects <= 0 or \
+       response.code not in (301, 302, 303, 307) or \
+       "Location" not in response.headers:
+        return None
+    redirect = copy.copy(request)
+    redirect.url = urllib.parse.urljoin(request.url,
+                                        response.headers["Location"])
+    redirect.max_redirects = request.max_redirects - 1
+    if response.code == 303 or (response.code in (301, 302) and
+                                request.method == "POST"):
+        redirect.method = "GET"
+        redirect.body = None
+    return redirect
+
+
+def _is_alive(stream):
+    """Returns True if the server has not closed an idle connection."""
+    if stream.closed():
+        return False
+    try:
+        data = stream.socket.recv(1, socket.MSG_PEEK)
+    except socket.error as e:
+        return e.errno in (errno.EWOULDBLOCK, errno.EAGAIN)
+    # Either the connection was closed or the server sent unexpected data
+    return False
@@ -28,6 +28,15 @@ the compiled templates:
     loader = template.Loader("/home/btaylor")
     print loader.load("test.html").generate(myvalue="XXX")
 
+Compiling a template is much more expensive than running it. To avoid paying
+that cost again in every process (pre-forked workers, autoreload restarts),
+give the Loader a BytecodeCache, which stores the compiled code on disk:
+
+    loader = template.Loader("/home/btaylor",
+        bytecode_cache=template.BytecodeCache("/tmp/btaylor-templates"))
+
+You can also compile every template up front with loader.preload().
+
 We compile all templates to raw Python. Error-reporting is currently... uh,
 interesting. Syntax for the templates
 
@@ -78,16 +87,36 @@ functions in to your template just like any other variable:
 
 We provide the functions escape(), url_escape(), json_encode(), and squeeze()
 to all templates by default.
+
+Expensive parts of a template can be cached with the cache block, which
+takes a key expression and an optional time-to-live in seconds:
+
+   {% cache "sidebar-" + locale.code, 300 %}
+     {% for entry in recent_entries() %}
+       <li>{{ escape(entry.title) }}</li>
+     {% end %}
+   {% end %}
+
+The rendered fragment is kept in the fragment_store of the template's
+Loader (see cache.MemoryStore and cache.FileStore) under the key, the
+name of the template and a checksum of its source, so editing the
+template never serves a stale fragment.
 """
 
 
 
 import io
+from . import cache
 import datetime
 from . import escape
+import hashlib
+import importlib.util
 import logging
+import marshal
+import os
 import os.path
 import re
+from . import version
 
 
 class Template:
@@ -97,13 +126,35 @@ class Template:
     the template from variables with generate().
     """
     def __init__(self, template_string, name="<string>", loader=None,
-                 compress_whitespace=None):
+                 compress_whitespace=None, bytecode_cache=None,
+                 fragment_store=None):
         self.name = name
+        self.fragment_store = fragment_store or _default_fragment_store
         if compress_whitespace is None:
             compress_whitespace = name.endswith(".html") or \
                 name.endswith(".js")
-        reader = _TemplateReader(name, template_string)
-        self.file = _File(_parse(reader))
+        self._source = template_string
+        self._file = None
+        # The bytecode cache is keyed by our own source, so a hit skips
+        # parsing us; it also remembers our dependencies, and the entry is
+        # only used if they have not changed since
+        source_checksum = self._compute_checksum(
+            [self.name, str(compress_whitespace), template_string])
+        if bytecode_cache is not None:
+            cached = bytecode_cache.load(source_checksum)
+            if cached is not None:
+                dependencies, code, compiled = cached
+                # The recorded names are already resolved
+                self.dependencies = self._load_dependencies(
+                    loader, dependencies, None)
+                if self.dependencies == dependencies:
+                    self.checksum = self._dependent_checksum(source_checksum)
+                    self.code, self.compiled = code, compiled
+                    return
+        names = []
+        self.file.find_dependencies(names)
+        self.dependencies = self._load_dependencies(loader, names, self.name)
+        self.checksum = self._dependent_checksum(source_checksum)
         self.code = self._generate_python(loader, compress_whitespace)
         try:
             self.compiled = compile(self.code, self.name, "exec")
@@ -111,6 +162,17 @@ class Template:
             formatted_code = _format_code(self.code).rstrip()
             logging.error("%s code:\n%s", self.name, formatted_code)
             raise
+        if bytecode_cache is not None:
+            bytecode_cache.dump(source_checksum, self.dependencies, self.code,
+                                self.compiled)
+
+    @property
+    def file(self):
+        """The parsed template, which is only parsed when first needed."""
+        if self._file is None:
+            reader = _TemplateReader(self.name, self._source)
+            self._file = _File(_parse(reader))
+        return self._file
 
     def generate(self, **kwargs):
         """Generate this template with the given arguments."""
@@ -120,6 +182,7 @@ class Template:
             "json_encode": escape.json_encode,
             "squeeze": escape.squeeze,
             "datetime": datetime,
+            "_cache_fragment": self._cache_fragment,
         }
         namespace.update(kwargs)
         exec(self.compiled, namespace)
@@ -131,6 +194,14 @@ class Template:
             logging.error("%s code:\n%s", self.name, formatted_code)
             raise
 
+    def _cache_fragment(self, prefix, render, key, ttl=None):
+        key = prefix + str(key)
+        value = self.fragment_store.get(key)
+        if value is None:
+            value = render()
+            self.fragment_store.set(key, value, ttl)
+        return value
+
     def _generate_python(self, loader, compress_whitespace):
         buffer = io.StringIO()
         try:
@@ -147,6 +218,34 @@ class Template:
         finally:
             buffer.close()
 
+    def _load_dependencies(self, loader, names, parent_path):
+        """Loads the templates we extend or include.
+
+        Returns a dictionary mapping their names to their checksums.
+        """
+        dependencies = {}
+        if not loader:
+            return dependencies
+        for name in names:
+            template = loader.load(name, parent_path)
+            dependencies[template.name] = template.checksum
+        return dependencies
+
+    def _dependent_checksum(self, source_checksum):
+        # The generated code inlines every template we extend or include,
+        # so their checksums are part of ours
+        parts = [source_checksum]
+        for name in sorted(self.dependencies):
+            parts.extend((name, self.dependencies[name]))
+        return self._compute_checksum(parts)
+
+    def _compute_checksum(self, parts):
+        hasher = hashlib.sha1()
+        for part in parts:
+            hasher.update(part.encode("utf8"))
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
     def _get_ancestors(self, loader):
         ancestors = [self.file]
         for chunk in self.file.body.chunks:
@@ -165,12 +264,70 @@ class Loader:
     You must use a template loader to use template constructs like
     {% extends %} and {% include %}. Loader caches all templates after
     they are loaded the first time.
+
+    If auto_reload is True, we check the modification time of a template
+    (and of every template it extends or includes) each time it is loaded,
+    and recompile it if anything has changed on disk.
+
+    The compiled templates are kept in a cache.LRUCache, which is unbounded
+    by default. max_templates limits the number of templates we keep, and
+    max_code_size limits the total length of their generated code.
+    Evicted templates are simply compiled again the next time they are
+    loaded. loader.templates.stats() reports hits, misses and evictions.
+
+    Fragments rendered by {% cache %} blocks are kept in fragment_store,
+    which defaults to a cache.MemoryStore private to this loader.
     """
-    def __init__(self, root_directory):
+    def __init__(self, root_directory, bytecode_cache=None, auto_reload=False,
+                 max_templates=None, max_code_size=None, fragment_store=None):
         self.root = os.path.abspath(root_directory)
-        self.templates = {}
+        self.bytecode_cache = bytecode_cache
+        self.fragment_store = fragment_store or cache.MemoryStore()
+        self.auto_reload = auto_reload
+        self.templates = cache.LRUCache(
+            max_entries=max_templates, max_size=max_code_size,
+            sizeof=lambda template: len(template.code))
 
     def load(self, name, parent_path=None):
+        name = self.resolve_path(name, parent_path)
+        template = self.templates.get(name)
+        if template is not None and self.auto_reload and \
+           self._is_stale(template):
+            logging.info("Reloading modified template %s", name)
+            template = None
+        if template is None:
+            template = self._create_template(name)
+            self.templates[name] = template
+        return template
+
+    def preload(self):
+        """Compiles every template under our root directory.
+
+        Call this before HTTPServer.start() forks worker processes so the
+        children share the compiled templates instead of each compiling them
+        on first use. Returns the names of the templates we loaded.
+        """
+        names = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                name = os.path.join(dirpath, filename)[len(self.root) + 1:]
+                try:
+                    self.load(name)
+                except Exception:
+                    logging.error("Could not preload template %s", name,
+                                  exc_info=True)
+                    continue
+                names.append(name)
+        return names
+
+    def resolve_path(self, name, parent_path=None):
+        """Returns the name of a template relative to our root directory.
+
+        Names are resolved relative to the template at parent_path, if given.
+        """
         if parent_path and not parent_path.startswith("<") and \
            not parent_path.startswith("/") and \
            not name.startswith("/"):
@@ -179,12 +336,97 @@ class Loader:
             relative_path = os.path.abspath(os.path.join(file_dir, name))
             if relative_path.startswith(self.root):
                 name = relative_path[len(self.root) + 1:]
-        if name not in self.templates:
-            path = os.path.join(self.root, name)
-            f = open(path, "r")
-            self.templates[name] = Template(f.read(), name=name, loader=self)
+        return name
+
+    def _create_template(self, name):
+        path = os.path.join(self.root, name)
+        # Stat before reading so a write racing with us is seen next time
+        signature = cache.file_signature(path)
+        f = open(path, "r")
+        try:
+            template = Template(f.read(), name=name, loader=self,
+                                bytecode_cache=self.bytecode_cache,
+                                fragment_store=self.fragment_store)
+        finally:
+            f.close()
+        template.file_signature = signature
+        return template
+
+    def _is_stale(self, template):
+        try:
+            path = os.path.join(self.root, template.name)
+            if cache.file_signature(path) != template.file_signature:
+                return True
+            # Loading a dependency reloads it if it is stale itself, which
+            # changes its checksum
+            for name, checksum in template.dependencies.items():
+                if self.load(name).checksum != checksum:
+                    return True
+        except (IOError, OSError):
+            return True
+        return False
+
+
+class BytecodeCache:
+    """Stores compiled templates on disk so other processes can reuse them.
+
+    Entries are keyed by a checksum of the template's own source, and by
+    the psyclone version and Python bytecode format, so templates are
+    neither parsed nor compiled on a hit. Each entry records the checksums
+    of the templates it extends or includes, and is ignored (and then
+    replaced) if any of them has changed. Entries for templates whose
+    source has since changed are never read again; delete the directory to
+    reclaim the space they use.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self._suffix = ".%s-%s.tplc" % (
+            version, importlib.util.MAGIC_NUMBER.hex())
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+
+    def load(self, checksum):
+        """Returns a (dependencies, code, compiled) tuple, or None.
+
+        dependencies maps the names of the templates extended or included
+        to their checksums when the entry was stored.
+        """
+        path = self._path(checksum)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            dependencies, code, compiled = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            logging.warning("Ignoring corrupt template cache file %s", path)
+            return None
+        finally:
             f.close()
-        return self.templates[name]
+        return dependencies, code, compiled
+
+    def dump(self, checksum, dependencies, code, compiled):
+        """Stores the generated code and code object for a template."""
+        path = self._path(checksum)
+        # Write to a private file and rename it into place, so processes
+        # reading the cache never see a partially written entry
+        temp_path = "%s.%d" % (path, os.getpid())
+        try:
+            f = open(temp_path, "wb")
+            try:
+                marshal.dump((dependencies, code, compiled), f)
+            finally:
+                f.close()
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            logging.warning("Could not write template cache file %s", path,
+                            exc_info=True)
+
+    def _path(self, checksum):
+        return os.path.join(self.directory, checksum + self._suffix)
 
 
 class _Node:
@@ -198,6 +440,10 @@ class _Node:
         for child in self.each_child():
             child.find_named_blocks(loader, named_blocks)
 
+    def find_dependencies(self, dependencies):
+        for child in self.each_child():
+            child.find_dependencies(dependencies)
+
 
 class _File(_Node):
     def __init__(self, body):
@@ -247,12 +493,18 @@ class _ExtendsBlock(_Node):
     def __init__(self, name):
         self.name = name
 
+    def find_dependencies(self, dependencies):
+        dependencies.append(self.name)
+
 
 class _IncludeBlock(_Node):
     def __init__(self, name, reader):
         self.name = name
         self.template_name = reader.name
 
+    def find_dependencies(self, dependencies):
+        dependencies.append(self.name)
+
     def find_named_blocks(self, loader, named_blocks):
         included = loader.load(self.name, self.template_name)
         included.file.find_named_blocks(loader, named_blocks)
@@ -285,6 +537,28 @@ class _ApplyBlock(_Node):
             self.method, method_name))
 
 
+class _CacheBlock(_Node):
+    def __init__(self, arguments, body=None):
+        self.arguments = arguments
+        self.body = body
+
+    def each_child(self):
+        return (self.body,)
+
+    def generate(self, writer):
+        method_name = "cache%d" % writer.apply_counter
+        writer.apply_counter += 1
+        writer.write_line("def %s():" % method_name)
+        with writer.indent():
+            writer.write_line("_buffer = []")
+            self.body.generate(writer)
+            writer.write_line("return ''.join(_buffer)")
+        template = writer.current_template
+        prefix = "%s:%s:" % (template.name, template.checksum)
+        writer.write_line("_buffer.append(_cache_fragment(%r, %s, %s))" % (
+            prefix, method_name, self.arguments))
+
+
 class _ControlBlock(_Node):
     def __init__(self, statement, body=None):
         self.statement = statement
@@ -436,6 +710,9 @@ class _TemplateReader:
         return self.text[self.pos:]
 
 
+_default_fragment_store = cache.MemoryStore()
+
+
 def _format_code(code):
     lines = code.splitlines()
     format = "%%%dd  %%s\n" % len(repr(len(lines) + 1))
@@ -542,7 +819,8 @@ def _parse(reader, in_block=None):
             body.chunks.append(block)
             continue
 
-        elif operator in ("apply", "block", "try", "if", "for", "while"):
+        elif operator in ("apply", "block", "cache", "try", "if", "for",
+                          "while"):
             # parse inner body recursively
             block_body = _parse(reader, operator)
             if operator == "apply":
@@ -553,6 +831,10 @@ def _parse(reader, in_block=None):
                 if not suffix:
                     raise ParseError("block missing name on line %d" % line)
                 block = _NamedBlock(suffix, block_body)
+            elif operator == "cache":
+                if not suffix:
+                    raise ParseError("cache missing key on line %d" % line)
+                block = _CacheBlock(suffix, block_body)
             else:
                 block = _ControlBlock(contents, block_body)
             body.chunks.append(block)
@@ -46,9 +46,11 @@ getting started guide.
 
 import base64
 import binascii
+from . import cache
 import calendar
+import concurrent.futures
+import copy
 import http.cookies
-import io
 import datetime
 import email.utils
 from . import escape
@@ -57,6 +59,8 @@ import gzip
 import hashlib
 import hmac
 import http.client
+from . import ioloop
+import json
 from . import locale
 import logging
 import mimetypes
@@ -69,8 +73,24 @@ import time
 import types
 import urllib.request, urllib.parse, urllib.error
 import uuid
+import zlib
 from .byte_utils import force_str, force_bytes
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class RequestHandler:
     """Subclass this class and define get() or post() to make a handler.
@@ -88,6 +108,7 @@ class RequestHandler:
         self._finished = False
         self._auto_finish = True
         self._transforms = transforms or []
+        self._response_cache_key = None
         self.ui = _O((n, self._ui_method(m)) for n, m in
                      application.ui_methods.items())
         self.ui["modules"] = _O((n, self._ui_module(n, m)) for n, m in
@@ -167,12 +188,12 @@ class RequestHandler:
             t = calendar.timegm(value.utctimetuple())
             value = email.utils.formatdate(t, localtime=False, usegmt=True)
         else:
-            value = str(value)
+            if not isinstance(value, str):
+                value = str(value)
             # If \n is allowed into the header, it is possible to inject
             # additional headers or split the request. Also cap length to
             # prevent obviously erroneous values.
-            safe_value = re.sub(r"[\x00-\x1f]", " ", value)[:4000]
-            if safe_value != value:
+            if len(value) > 4000 or _UNSAFE_HEADER_CHARS.search(value):
                 raise ValueError("Unsafe header value %r", value)
         self._headers[name] = value
 
@@ -414,12 +435,8 @@ class RequestHandler:
             while frame.f_code.co_filename == web_file:
                 frame = frame.f_back
             template_path = os.path.dirname(frame.f_code.co_filename)
-        if not getattr(RequestHandler, "_templates", None):
-            RequestHandler._templates = {}
-        if template_path not in RequestHandler._templates:
-            RequestHandler._templates[template_path] = template.Loader(
-                template_path)
-        t = RequestHandler._templates[template_path].load(template_name)
+        loader = _get_template_loader(template_path, self.application.settings)
+        t = loader.load(template_name)
         args = dict(
             handler=self,
             request=self.request,
@@ -458,7 +475,10 @@ class RequestHandler:
             return
 
         if headers or chunk:
-            self.request.write(headers + chunk)
+            # Transforms may return a list of buffers (see OutputTransform)
+            if not isinstance(chunk, list):
+                chunk = [chunk]
+            self.request.write([headers] + chunk)
 
     def finish(self, chunk=None):
         """Finishes this response, ending the HTTP request."""
@@ -468,17 +488,18 @@ class RequestHandler:
         # Automatically support ETags and add the Content-Length header if
         # we have not flushed any content yet.
         if not self._headers_written:
+            etag = None
             if self._status_code == 200 and self.request.method == "GET":
-                hasher = hashlib.sha1()
-                for part in self._write_buffer:
-                    hasher.update(part)
-                etag = '"%s"' % hasher.hexdigest()
-                inm = self.request.headers.get("If-None-Match")
-                if inm and inm.find(etag) != -1:
-                    self._write_buffer = []
-                    self.set_status(304)
-                else:
-                    self.set_header("Etag", etag)
+                etag = self._headers.get("Etag")
+                if etag is None:
+                    etag = self.compute_etag()
+                    if etag is not None:
+                        self.set_header("Etag", etag)
+            if self._response_cache_key is not None:
+                self._store_cached_response()
+            if etag is not None and self._etag_matches(etag):
+                self._write_buffer = []
+                self.set_status(304)
             if "Content-Length" not in self._headers:
                 content_length = sum(len(part) for part in self._write_buffer)
                 self.set_header("Content-Length", content_length)
@@ -489,6 +510,40 @@ class RequestHandler:
             self._log()
         self._finished = True
 
+    def compute_etag(self):
+        """Computes the Etag header from the buffered response body.
+
+        We use xxhash if it is installed, and a CRC32 of the body plus its
+        length otherwise. Override this method to use a different hash, or
+        to return None to send no Etag at all. Handlers that already know
+        the version of the resource they serve should override
+        get_version_etag() instead, which is cheaper still.
+        """
+        if xxhash is not None:
+            hasher = xxhash.xxh64()
+            for part in self._write_buffer:
+                hasher.update(part)
+            return '"%s"' % hasher.hexdigest()
+        crc = 0
+        length = 0
+        for part in self._write_buffer:
+            crc = zlib.crc32(part, crc)
+            length += len(part)
+        return '"%08x-%x"' % (crc, length)
+
+    def get_version_etag(self, *args, **kwargs):
+        """Override to return the version of the resource being requested.
+
+        This method is called with the same arguments as get() or head(),
+        after prepare(). If it returns a value, we use it as the Etag and
+        respond 304 Not Modified without calling get() at all when the
+        client already has that version, e.g.:
+
+            def get_version_etag(self, slug):
+                return self.db.get_entry_revision(slug)
+        """
+        return None
+
     def send_error(self, status_code=500, **kwargs):
         """Sends the given HTTP error code to the browser.
 
@@ -659,24 +714,16 @@ class RequestHandler:
         full host for every static URL, including the "http://". Set
         this attribute for handlers whose output needs non-relative static
         path names.
+
+        Signatures come from Application.static_manifest; see
+        StaticManifest for how they are computed and kept up to date.
         """
         self.require_setting("static_path", "static_url")
-        if not hasattr(RequestHandler, "_static_hashes"):
-            RequestHandler._static_hashes = {}
-        hashes = RequestHandler._static_hashes
-        if path not in hashes:
-            try:
-                f = open(os.path.join(
-                    self.application.settings["static_path"], path))
-                hashes[path] = hashlib.md5(force_bytes(f.read())).hexdigest()
-                f.close()
-            except IOError:
-                logging.error("Could not open static file %r", path)
-                hashes[path] = None
+        version = self.application.static_manifest.get(path)
         base = self.request.protocol + "://" + self.request.host \
             if getattr(self, "include_host", False) else ""
-        if hashes.get(path):
-            return base + "/static/" + path + "?v=" + hashes[path][:5]
+        if version:
+            return base + "/static/" + path + "?v=" + version[:5]
         else:
             return base + "/static/" + path
 
@@ -720,22 +767,141 @@ class RequestHandler:
             if self.request.method == "POST" and \
                self.application.settings.get("xsrf_cookies"):
                 self.check_xsrf_cookie()
+            method = getattr(self, self.request.method.lower())
+            cache_options = getattr(method, "response_cache_options", None)
+            if cache_options is not None and \
+               self._serve_cached_response(cache_options):
+                return
             self.prepare()
+            if not self._finished and self.request.method in ("GET", "HEAD"):
+                version = self.get_version_etag(*args, **kwargs)
+                if version is not None:
+                    etag = '"%s"' % version
+                    self.set_header("Etag", etag)
+                    if self._etag_matches(etag):
+                        self.set_status(304)
+                        self.finish()
             if not self._finished:
-                getattr(self, self.request.method.lower())(*args, **kwargs)
+                method(*args, **kwargs)
                 if self._auto_finish and not self._finished:
                     self.finish()
         except Exception as e:
             self._handle_request_exception(e)
 
+    def _etag_matches(self, etag):
+        inm = self.request.headers.get("If-None-Match")
+        if not inm:
+            return False
+        if inm.strip() == "*":
+            return True
+        # Weak comparison, see RFC 2616 section 13.3.3
+        etag = etag[2:] if etag.startswith("W/") else etag
+        for candidate in inm.split(","):
+            candidate = candidate.strip()
+            if candidate.startswith("W/"):
+                candidate = candidate[2:]
+            if candidate == etag:
+                return True
+        return False
+
+    def _serve_cached_response(self, options):
+        """Finishes the request from the response cache if we can.
+
+        Returns False if the handler method should run instead, in which case
+        finish() stores the response it produces.
+        """
+        key = (self.request.method, self.request.host, self.request.uri) + \
+            tuple(self.request.headers.get(h) for h in options["vary"])
+        cached = self.application.response_cache.get(key)
+        now = self.settings.get("response_cache_clock", time.time)()
+        if cached is not None and now >= cached.expires:
+            # Past its expiration, the stale copy is served while a copy of
+            # this request regenerates the response in the background
+            if now >= cached.stale_until or \
+               getattr(self.request, "_revalidation", False):
+                cached = None
+            elif not cached.revalidating:
+                if self._revalidate_cached_response():
+                    cached.revalidating = True
+                else:
+                    cached = None
+        if cached is None:
+            self._response_cache_key = key
+            self._response_cache_options = options
+            return False
+        self._status_code = cached.status_code
+        self._headers.update(cached.headers)
+        self.set_header("Age", int(now - cached.created))
+        self._write_buffer = [cached.body]
+        self.finish()
+        return True
+
+    def _revalidate_cached_response(self):
+        """Schedules a copy of this request to regenerate its cached response.
+
+        Returns False if there is no IOLoop to run it on (e.g. under WSGI).
+        """
+        connection = getattr(self.request, "connection", None)
+        io_loop = self.settings.get("io_loop") or \
+            getattr(getattr(connection, "stream", None), "io_loop", None)
+        if io_loop is None:
+            return False
+        headers = copy.copy(self.request.headers)
+        headers.pop("If-None-Match", None)
+        headers.pop("If-Modified-Since", None)
+        request = type(self.request)(
+            self.request.method, self.request.uri,
+            version=self.request.version, headers=headers,
+            remote_ip=self.request.remote_ip,
+            protocol=self.request.protocol, host=self.request.host,
+            connection=_RevalidationConnection())
+        request._revalidation = True
+        io_loop.add_callback(functools.partial(self.application, request))
+        return True
+
+    def _store_cached_response(self):
+        cache_control = self._headers.get("Cache-Control", "")
+        if self._status_code != 200 or \
+           getattr(self, "_new_cookies", None) or \
+           "private" in cache_control or "no-store" in cache_control:
+            if getattr(self.request, "_revalidation", False):
+                # Let the next stale request try again
+                stale = self.application.response_cache.get(
+                    self._response_cache_key)
+                if stale is not None:
+                    stale.revalidating = False
+            return
+        headers = dict((n, v) for n, v in self._headers.items()
+                       if n not in ("Connection", "Content-Length"))
+        options = self._response_cache_options
+        now = self.settings.get("response_cache_clock", time.time)()
+        self.application.response_cache[self._response_cache_key] = \
+            _CachedResponse(self._status_code, headers,
+                            b"".join(self._write_buffer), now,
+                            options["ttl"], options["stale"])
+
     def _generate_headers(self):
-        lines = [self.request.version + " " + str(self._status_code) + " " +
-                 http.client.responses[self._status_code]]
-        lines.extend(["%s: %s" % (n, v) for n, v in self._headers.items()])
+        status_line = _STATUS_LINES.get(
+            (self.request.version, self._status_code))
+        if status_line is None:
+            status_line = ("%s %d %s\r\n" % (
+                self.request.version, self._status_code,
+                http.client.responses[self._status_code])).encode("utf8")
+        lines = [status_line]
+        for name, value in self._headers.items():
+            line = _HEADER_LINES.get((name, value))
+            if line is None:
+                line = ("%s: %s\r\n" % (name, value)).encode("utf8")
+                if name in _CONSTANT_HEADERS and \
+                   len(_HEADER_LINES) < _MAX_HEADER_LINES:
+                    _HEADER_LINES[(name, value)] = line
+            lines.append(line)
         for cookie_dict in getattr(self, "_new_cookies", []):
             for cookie in list(cookie_dict.values()):
-                lines.append("Set-Cookie: " + cookie.OutputString(None))
-        return bytes("\r\n".join(lines) + "\r\n\r\n", "utf8")
+                lines.append(("Set-Cookie: %s\r\n" %
+                              cookie.OutputString(None)).encode("utf8"))
+        lines.append(b"\r\n")
+        return b"".join(lines)
 
     def _log(self):
         if self._status_code < 400:
@@ -810,6 +976,40 @@ def asynchronous(method):
     return wrapper
 
 
+def cached(ttl, stale=0, vary=()):
+    """Caches the complete responses of a GET or HEAD handler method.
+
+    Responses are kept in the application's response cache for ttl seconds,
+    keyed by method, host, URI and the values of the request headers named
+    in vary. Cache hits are served before prepare() is called, so the
+    handler does no work at all:
+
+        class HomeHandler(web.RequestHandler):
+            @web.cached(ttl=60, stale=300, vary=("Accept-Language",))
+            def get(self):
+                self.render("home.html")
+
+    Once a response has expired, it may be served stale for up to stale more
+    seconds while a copy of the first stale request regenerates it in the
+    background on the application's IOLoop. Only 200 responses that
+    set no cookies and are not marked private or no-store are cached, so
+    only use this decorator for pages that look the same to every user.
+
+    The cache is bounded by the response_cache_size application setting
+    (in bytes of response body, 16MB by default). Expiration is measured
+    with the response_cache_clock setting, a function returning the
+    current time in seconds (time.time by default).
+    """
+    def decorator(method):
+        method.response_cache_options = {
+            "ttl": ttl,
+            "stale": stale,
+            "vary": tuple(vary),
+        }
+        return method
+    return decorator
+
+
 def removeslash(method):
     """Use this decorator to remove trailing slashes from the request path.
 
@@ -887,12 +1087,28 @@ class Application:
     You can serve static files by sending the static_path setting as a
     keyword argument. We will serve those files from the /static/ URI,
     and we will serve /favicon.ico and /robots.txt from the same directory.
+
+    When static_path is set, we hash every static file for static_url()
+    when the application is created, or load the hashes from the manifest
+    file named by the static_manifest_path setting if it exists (see
+    StaticManifest). The static_manifest_threads setting hashes files in
+    a thread pool of that size. Every static_refresh_interval seconds (1 in
+    debug mode, never otherwise) we rehash the files that have changed, in
+    a background thread, on the IOLoop given by the io_loop setting (by
+    default IOLoop.instance()).
+
+    If the preload_templates setting is True, we compile every template
+    under template_path when the application is created. Create the
+    application before calling HTTPServer.start() so pre-forked children
+    inherit the compiled templates rather than compiling their own.
     """
     def __init__(self, handlers=None, default_host="", transforms=None,
                  wsgi=False, **settings):
         if transforms is None:
             self.transforms = []
-            if settings.get("gzip"):
+            if settings.get("compress_response"):
+                self.transforms.append(ContentEncoding)
+            elif settings.get("gzip"):
                 self.transforms.append(GZipContentEncoding)
             self.transforms.append(ChunkedTransferEncoding)
         else:
@@ -901,6 +1117,12 @@ class Application:
         self.named_handlers = {}
         self.default_host = default_host
         self.settings = settings
+        self.response_cache = cache.LRUCache(
+            max_size=settings.get("response_cache_size", 16 * 1024 * 1024),
+            sizeof=lambda response: len(response.body))
+        self.static_cache = cache.LRUCache(
+            max_size=settings.get("static_cache_size", 16 * 1024 * 1024),
+            sizeof=lambda static_file: static_file.memory_size())
         self.ui_modules = {}
         self.ui_methods = {}
         self._wsgi = wsgi
@@ -908,6 +1130,19 @@ class Application:
         self._load_ui_methods(settings.get("ui_methods", {}))
         if self.settings.get("static_path"):
             path = self.settings["static_path"]
+            self.static_manifest = StaticManifest(path)
+            manifest_path = self.settings.get("static_manifest_path")
+            if manifest_path and os.path.exists(manifest_path):
+                self.static_manifest.load(manifest_path)
+            else:
+                self.static_manifest.build(
+                    threads=self.settings.get("static_manifest_threads"))
+            interval = self.settings.get(
+                "static_refresh_interval",
+                1 if self.settings.get("debug") else None)
+            if interval and not wsgi:
+                self.static_manifest.start_refresh(
+                    interval, io_loop=self.settings.get("io_loop"))
             handlers = list(handlers or [])
             handlers.extend([
                 (r"/static/(.*)", StaticFileHandler, dict(path=path)),
@@ -915,6 +1150,12 @@ class Application:
                 (r"/(robots\.txt)", StaticFileHandler, dict(path=path)),
             ])
         if handlers: self.add_handlers(".*$", handlers)
+        if self.settings.get("preload_templates"):
+            if not self.settings.get("template_path"):
+                raise Exception("You must define the 'template_path' setting "
+                                "in your application to use preload_templates")
+            _get_template_loader(self.settings["template_path"],
+                                 self.settings).preload()
 
         # Automatically reload modified modules
         if self.settings.get("debug") and not wsgi:
@@ -1004,12 +1245,6 @@ class Application:
             if not handler:
                 handler = ErrorHandler(self, request, 404)
 
-        # In debug mode, re-compile templates and reload static files on every
-        # request so you don't need to restart to see changes
-        if self.settings.get("debug"):
-            RequestHandler._templates = None
-            RequestHandler._static_hashes = {}
-
         handler._execute(transforms, *args)
         return handler
 
@@ -1084,56 +1319,408 @@ class StaticFileHandler(RequestHandler):
     with the path, we set an infinite HTTP expiration header. So, if you
     want browsers to cache a file indefinitely, send them to, e.g.,
     /static/images/myimage.png?v=xxx.
+
+    Files of at least SENDFILE_MIN_SIZE bytes are copied to the socket with
+    os.sendfile() (see IOStream.write_file), so they are never read into
+    memory. Smaller files are written with the response headers in a single
+    packet instead.
+
+    We cache the stat information and MIME type of the files we serve in
+    Application.static_cache, along with the contents of files no larger
+    than the static_cache_max_file_size setting (256KB by default) and
+    their gzip (and, if the brotli module is installed, brotli) encodings.
+    The static_cache_size setting bounds the memory used (16MB by default).
+    Cached files are checked for changes at most every
+    static_cache_check_interval seconds (2 by default, and on every request
+    in debug mode).
     """
+    SENDFILE_MIN_SIZE = 64 * 1024
+
     def __init__(self, application, request, path):
         super().__init__(application, request)
         self.root = os.path.abspath(path) + "/"
+        self._static_file = None
 
     def head(self, path):
         self.get(path, include_body=False)
 
+    def get_version_etag(self, path):
+        static_file = self._get_static_file(path)
+        version = "%x-%x" % (static_file.modified, static_file.size)
+        # Each precompressed variant is a different representation, so it
+        # needs its own strong validator
+        encoding = self._response_encoding(static_file)
+        if encoding is not None:
+            version += "-" + encoding
+        return version
+
     def get(self, path, include_body=True):
-        abspath = os.path.abspath(os.path.join(self.root, path))
-        if not abspath.startswith(self.root):
-            raise HTTPError(403, "%s is not in root static directory", path)
-        if not os.path.exists(abspath):
-            raise HTTPError(404)
-        if not os.path.isfile(abspath):
-            raise HTTPError(403, "%s is not a file", path)
+        static_file = self._get_static_file(path)
+        modified = static_file.modified
+        size = static_file.size
 
         # Check the If-Modified-Since, and don't send the result if the
         # content has not been modified
-        stat_result = os.stat(abspath)
-        modified = datetime.datetime.fromtimestamp(stat_result[stat.ST_MTIME])
-        ims_value = self.request.headers.get("If-Modified-Since")
-        if ims_value is not None:
-            date_tuple = email.utils.parsedate(ims_value)
-            if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
-            if if_since >= modified:
-                self.set_status(304)
-                return
+        if_since = _parse_http_date(
+            self.request.headers.get("If-Modified-Since"))
+        if if_since is not None and if_since >= modified:
+            self.set_status(304)
+            return
 
-        self.set_header("Last-Modified", modified)
-        self.set_header("Content-Length", stat_result[stat.ST_SIZE])
+        self.set_header("Last-Modified", email.utils.formatdate(
+            modified, localtime=False, usegmt=True))
+        self.set_header("Accept-Ranges", "bytes")
         if "v" in self.request.arguments:
             self.set_header("Expires", datetime.datetime.utcnow() + \
                                        datetime.timedelta(days=365*10))
             self.set_header("Cache-Control", "max-age=" + str(86400*365*10))
         else:
             self.set_header("Cache-Control", "public")
-        mime_type, encoding = mimetypes.guess_type(abspath)
+        mime_type = static_file.mime_type
         if mime_type:
             self.set_header("Content-Type", mime_type)
+        if static_file.variants:
+            self.set_header("Vary", "Accept-Encoding")
+
+        ranges = None
+        if "Range" in self.request.headers and \
+           self._if_range_matches(modified):
+            ranges = _parse_range_header(self.request.headers["Range"], size)
+        if ranges is None:
+            encoding = self._response_encoding(static_file)
+            if encoding is not None:
+                self.set_header("Content-Encoding", encoding)
+                self.set_header("Content-Length",
+                                len(static_file.variants[encoding]))
+                if include_body:
+                    self.write(static_file.variants[encoding])
+                return
+            self.set_header("Content-Length", size)
+            parts = [(None, 0, size)]
+        elif not ranges:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+            return
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.set_status(206)
+            self.set_header("Content-Range",
+                            "bytes %d-%d/%d" % (start, end - 1, size))
+            self.set_header("Content-Length", end - start)
+            parts = [(None, start, end)]
+        else:
+            boundary = binascii.hexlify(os.urandom(12)).decode("ascii")
+            part_type = mime_type or "application/octet-stream"
+            parts = []
+            for start, end in ranges:
+                head = "\r\n--%s\r\nContent-Type: %s\r\n" \
+                       "Content-Range: bytes %d-%d/%d\r\n\r\n" % (
+                           boundary, part_type, start, end - 1, size)
+                parts.append((head.encode("latin1"), start, end))
+            parts.append((("\r\n--%s--\r\n" % boundary).encode("latin1"),
+                          0, 0))
+            self.set_status(206)
+            self.set_header("Content-Type",
+                            "multipart/byteranges; boundary=" + boundary)
+            self.set_header("Content-Length", sum(
+                len(head) + end - start for head, start, end in parts))
 
         if not include_body:
             return
-        file = open(abspath, "r")
+        self._write_parts(static_file, parts)
+
+    def _get_static_file(self, path):
+        """Returns the _StaticFile for path, from the cache if possible."""
+        if self._static_file is not None:
+            return self._static_file
+        abspath = os.path.abspath(os.path.join(self.root, path))
+        if not abspath.startswith(self.root):
+            raise HTTPError(403, "%s is not in root static directory", path)
+        settings = self.application.settings
+        static_cache = self.application.static_cache
+        static_file = static_cache.get(abspath)
+        if static_file is not None:
+            interval = settings.get("static_cache_check_interval",
+                                    0 if settings.get("debug") else 2)
+            now = time.time()
+            if now - static_file.checked >= interval:
+                if cache.file_signature(abspath) == static_file.signature:
+                    static_file.checked = now
+                else:
+                    static_cache.pop(abspath)
+                    static_file = None
+        if static_file is None:
+            try:
+                stat_result = os.stat(abspath)
+            except OSError:
+                raise HTTPError(404)
+            if not stat.S_ISREG(stat_result.st_mode):
+                raise HTTPError(403, "%s is not a file", path)
+            static_file = _StaticFile(abspath, stat_result, settings.get(
+                "static_cache_max_file_size", 256 * 1024))
+            static_cache[abspath] = static_file
+        self._static_file = static_file
+        return static_file
+
+    def _choose_encoding(self, static_file):
+        """Returns the best precompressed encoding the client accepts."""
+        if not static_file.variants:
+            return None
+        return _negotiate_encoding(
+            self.request.headers.get("Accept-Encoding", ""),
+            [e for e in ("br", "gzip") if e in static_file.variants])
+
+    def _response_encoding(self, static_file):
+        """Returns the encoding of the body get() will send, or None.
+
+        Range requests are always answered from the identity body, even
+        when the range is not honored, so that the Etag sent up front
+        matches the body.
+        """
+        if "Range" in self.request.headers:
+            return None
+        return self._choose_encoding(static_file)
+
+    def _if_range_matches(self, modified):
+        """Returns False if an If-Range header says the client's copy is old.
+
+        If-Range holds either an Etag or a date, and we only honor the Range
+        header when it matches the current version of the file.
+        """
+        value = self.request.headers.get("If-Range")
+        if value is None:
+            return True
+        if value.startswith(('"', "W/")):
+            # Weak Etags never match, see RFC 2616 section 14.27
+            return value == self._headers.get("Etag")
+        return _parse_http_date(value) == modified
+
+    def _write_parts(self, static_file, parts):
+        """Writes (head, start, end) parts: a prefix and a range of the file.
+
+        Cached files are written from memory. Large responses are handed to
+        the stream with write_file so they never pass through memory.
+        """
+        abspath = static_file.abspath
+        if static_file.content is not None:
+            for head, start, end in parts:
+                if head:
+                    self.write(head)
+                if end > start:
+                    self.write(static_file.content[start:end])
+            return
+        length = sum(end - start for head, start, end in parts)
+        if length >= self.SENDFILE_MIN_SIZE and not self.application._wsgi:
+            for head, start, end in parts:
+                if head:
+                    self.write(head)
+                if end > start:
+                    self.flush()
+                    self.request.write_file(open(abspath, "rb"), start,
+                                            end - start)
+            return
+        file = open(abspath, "rb")
         try:
-            self.write(file.read())
+            for head, start, end in parts:
+                if head:
+                    self.write(head)
+                if end > start:
+                    file.seek(start)
+                    self.write(file.read(end - start))
         finally:
             file.close()
 
 
+class StaticManifest:
+    """The version hashes of the files in a static directory.
+
+    static_url() appends a prefix of the MD5 of each file to its URL. We
+    compute those hashes once when the application is created, rather than
+    on the request path, and record the modification time and size of each
+    file so refresh() only rehashes the files that have changed. Files
+    that are not in the manifest are hashed the first time they are asked
+    for, and checked for changes each time after that, since nothing else
+    refreshes them outside debug mode. Files that do not exist have no
+    hash and are not remembered.
+
+    Hashing a large static directory can slow down startup, so manifests
+    can be built and saved when you deploy your application:
+
+        manifest = web.StaticManifest("/var/www/static")
+        manifest.build(threads=8)
+        manifest.save("/var/www/static-manifest.json")
+
+    and loaded by the application with the static_manifest_path setting.
+    Loaded hashes are trusted until refresh() is called, or until the
+    periodic background refresh begun with start_refresh() runs.
+    """
+    def __init__(self, static_path):
+        self.static_path = os.path.abspath(static_path)
+        self.entries = {}
+        self._on_demand = set()
+        self._refresh_callback = None
+        self._refresh_executor = None
+        self._refreshing = False
+
+    def get(self, path):
+        """Returns the hash of the file at the given relative path, or None.
+        """
+        entry = self.entries.get(path)
+        if entry is None or path in self._on_demand:
+            signature = _manifest_signature(self._abspath(path))
+            if signature is None:
+                self.entries.pop(path, None)
+                self._on_demand.discard(path)
+                return None
+            if entry is None or entry[0] != signature:
+                entry = self._hash_file(path)
+                self.entries[path] = entry
+                self._on_demand.add(path)
+        return entry[1]
+
+    def build(self, threads=None):
+        """Hashes every file under static_path, in a thread pool if threads
+        is given.
+        """
+        paths = list(self._walk())
+        if threads:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                entries = list(executor.map(self._hash_file, paths))
+        else:
+            entries = [self._hash_file(path) for path in paths]
+        self.entries = dict(zip(paths, entries))
+        self._on_demand.clear()
+
+    def refresh(self):
+        """Rehashes the files that have changed since they were hashed.
+
+        Files that have been deleted are dropped from the manifest.
+        """
+        self._apply(self._changes(dict(self.entries)))
+
+    def start_refresh(self, interval, io_loop=None):
+        """Refreshes the manifest every interval seconds in the background.
+
+        The directory is walked and files are hashed in a worker thread, and
+        the new hashes are applied on the IOLoop, so requests are never held
+        up by a refresh. Call stop_refresh() to stop.
+        """
+        self.stop_refresh()
+        io_loop = io_loop or ioloop.IOLoop.instance()
+        self._refresh_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._refresh_callback = ioloop.PeriodicCallback(
+            functools.partial(self._refresh_in_background, io_loop),
+            interval * 1000, io_loop=io_loop)
+        self._refresh_callback.start()
+
+    def stop_refresh(self):
+        if self._refresh_callback is not None:
+            self._refresh_callback.stop()
+            self._refresh_callback = None
+            self._refresh_executor.shutdown(wait=False)
+            self._refresh_executor = None
+
+    def _refresh_in_background(self, io_loop):
+        if self._refreshing or self._refresh_executor is None:
+            return
+        self._refreshing = True
+        future = self._refresh_executor.submit(
+            self._changes, dict(self.entries))
+        # Futures call back on the worker thread
+        future.add_done_callback(lambda future: io_loop.add_callback(
+            functools.partial(self._on_refreshed, future)))
+
+    def _on_refreshed(self, future):
+        self._refreshing = False
+        try:
+            self._apply(future.result())
+        except Exception:
+            logging.error("Could not refresh static manifest", exc_info=True)
+
+    def _changes(self, entries):
+        """Returns new entries for the files that differ from entries.
+
+        Files that no longer exist map to None.
+        """
+        changes = {}
+        for path, (signature, version) in entries.items():
+            current = _manifest_signature(self._abspath(path))
+            if current is None:
+                changes[path] = None
+            elif current != signature:
+                changes[path] = self._hash_file(path)
+        for path in self._walk():
+            if path not in entries:
+                changes[path] = self._hash_file(path)
+        return changes
+
+    def _apply(self, changes):
+        for path, entry in changes.items():
+            if entry is None:
+                self.entries.pop(path, None)
+                self._on_demand.discard(path)
+            else:
+                self.entries[path] = entry
+
+    def load(self, manifest_path):
+        f = open(manifest_path, "r")
+        try:
+            files = json.load(f)["files"]
+        finally:
+            f.close()
+        self.entries = dict(
+            (path, ((entry["mtime"], entry["size"]), entry["hash"]))
+            for path, entry in files.items())
+        self._on_demand.clear()
+
+    def save(self, manifest_path):
+        files = {}
+        for path, (signature, version) in self.entries.items():
+            if version is not None:
+                files[path] = {"mtime": signature[0], "size": signature[1],
+                               "hash": version}
+        temp_path = "%s.%d" % (manifest_path, os.getpid())
+        f = open(temp_path, "w")
+        try:
+            json.dump({"files": files}, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(temp_path, manifest_path)
+
+    def _walk(self):
+        for root, dirs, files in os.walk(self.static_path):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in files:
+                if name.startswith("."):
+                    continue
+                path = os.path.relpath(os.path.join(root, name),
+                                       self.static_path)
+                yield path.replace(os.sep, "/")
+
+    def _abspath(self, path):
+        return os.path.join(self.static_path, path)
+
+    def _hash_file(self, path):
+        """Returns the (signature, hash) entry for the file at path."""
+        abspath = self._abspath(path)
+        signature = _manifest_signature(abspath)
+        try:
+            f = open(abspath, "rb")
+        except IOError:
+            logging.error("Could not open static file %r", path)
+            return (signature, None)
+        try:
+            md5 = hashlib.md5()
+            while True:
+                block = f.read(64 * 1024)
+                if not block:
+                    break
+                md5.update(block)
+        finally:
+            f.close()
+        return (signature, md5.hexdigest())
+
+
 class FallbackHandler(RequestHandler):
     """A RequestHandler that wraps another HTTP server callback.
 
@@ -1163,6 +1750,10 @@ class OutputTransform:
     A new transform instance is created for every request. See the
     ChunkedTransferEncoding example below if you want to implement a
     new Transform.
+
+    Transforms may return a list of bytes objects instead of a single
+    chunk, which are written in order without being joined. Only the last
+    transform in an application's list may do this.
     """
     def __init__(self, request):
         pass
@@ -1174,8 +1765,61 @@ class OutputTransform:
         return chunk
 
 
-class GZipContentEncoding(OutputTransform):
-    """Applies the gzip content encoding to the response.
+class _ZlibCompressor:
+    def __init__(self, level, wbits):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data, finishing):
+        # Z_SYNC_FLUSH lets the client decode everything flushed so far
+        return self._compressor.compress(data) + self._compressor.flush(
+            zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+
+
+class _BrotliCompressor:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data, finishing):
+        data = self._compressor.process(data)
+        if finishing:
+            return data + self._compressor.finish()
+        return data + self._compressor.flush()
+
+
+class _ZstdCompressor:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data, finishing):
+        return self._compressor.compress(data) + self._compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_FINISH if finishing else
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+
+class ContentEncoding(OutputTransform):
+    """Compresses the response with the best encoding the client accepts.
+
+    We negotiate with the client's Accept-Encoding header, including its
+    quality values, choosing among the ENCODINGS whose codec is available
+    (brotli and zstd need the brotli and zstandard modules), in order of
+    preference. CODECS maps each encoding to a function that takes a
+    compression level from LEVELS and returns an object with a
+    compress(data, finishing) method; add to both to support a new coding.
+
+    Only responses with one of the CONTENT_TYPES are compressed, and
+    responses finished in a single chunk shorter than MIN_LENGTH are left
+    alone. Streamed responses are compressed chunk by chunk as they are
+    flushed.
+
+    Responses finished in a single chunk with a strong Etag are compressed
+    once per encoding: we keep the compressed body in compressed_cache, an
+    LRUCache keyed by the host and path, a digest of the uncompressed body
+    and the encoding. Etags are only unique per resource (and handlers can
+    set their own), so they are not part of the key. stats() returns the
+    bytes in and out, compression ratio and time spent compressing for each
+    encoding.
+
+    Use this transform with the compress_response application setting.
 
     See http://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html#sec14.11
     """
@@ -1183,41 +1827,92 @@ class GZipContentEncoding(OutputTransform):
         "text/plain", "text/html", "text/css", "text/xml",
         "application/x-javascript", "application/xml", "application/atom+xml",
         "text/javascript", "application/json", "application/xhtml+xml"])
+    ENCODINGS = ("br", "zstd", "gzip", "deflate")
+    LEVELS = {"br": 4, "zstd": 3, "gzip": 6, "deflate": 6}
+    CODECS = {
+        "gzip": lambda level: _ZlibCompressor(level, 16 + zlib.MAX_WBITS),
+        "deflate": lambda level: _ZlibCompressor(level, zlib.MAX_WBITS),
+    }
+    if brotli is not None:
+        CODECS["br"] = _BrotliCompressor
+    if zstandard is not None:
+        CODECS["zstd"] = _ZstdCompressor
     MIN_LENGTH = 5
+    compressed_cache = cache.LRUCache(max_size=8 * 1024 * 1024, sizeof=len)
+    _metrics = {}
 
     def __init__(self, request):
-        self._gzipping = request.supports_http_1_1() and \
-            "gzip" in request.headers.get("Accept-Encoding", "")
+        self._encoding = None
+        self._compressor = None
+        self._resource = (request.host, request.path)
+        if request.supports_http_1_1():
+            self._encoding = _negotiate_encoding(
+                request.headers.get("Accept-Encoding", ""),
+                [e for e in self.ENCODINGS if e in self.CODECS])
 
     def transform_first_chunk(self, headers, chunk, finishing):
-        if self._gzipping:
-            ctype = headers.get("Content-Type", "").split(";")[0]
-            self._gzipping = (ctype in self.CONTENT_TYPES) and \
-                (not finishing or len(chunk) >= self.MIN_LENGTH) and \
-                (finishing or "Content-Length" not in headers) and \
-                ("Content-Encoding" not in headers)
-        if self._gzipping:
-            headers["Content-Encoding"] = "gzip"
-            self._gzip_value = io.StringIO()
-            self._gzip_file = gzip.GzipFile(mode="w", fileobj=self._gzip_value)
-            self._gzip_pos = 0
+        ctype = headers.get("Content-Type", "").split(";")[0]
+        if ctype not in self.CONTENT_TYPES or \
+           "Content-Encoding" in headers or "Content-Range" in headers or \
+           (not finishing and "Content-Length" in headers):
+            self._encoding = None
+            return headers, chunk
+        vary = headers.get("Vary")
+        headers["Vary"] = vary + ", Accept-Encoding" if vary else \
+            "Accept-Encoding"
+        if self._encoding is None or \
+           (finishing and len(chunk) < self.MIN_LENGTH):
+            self._encoding = None
+            return headers, chunk
+        headers["Content-Encoding"] = self._encoding
+        etag = headers.get("Etag")
+        if finishing and etag and not etag.startswith("W/"):
+            key = self._resource + (hashlib.sha1(chunk).digest(),
+                                    self._encoding)
+            compressed = self.compressed_cache.get(key)
+            if compressed is None:
+                compressed = self.transform_chunk(chunk, finishing)
+                self.compressed_cache[key] = compressed
+            chunk = compressed
+        else:
             chunk = self.transform_chunk(chunk, finishing)
-            if "Content-Length" in headers:
-                headers["Content-Length"] = str(len(chunk))
+        if "Content-Length" in headers:
+            headers["Content-Length"] = str(len(chunk))
         return headers, chunk
 
     def transform_chunk(self, chunk, finishing):
-        if self._gzipping:
-            self._gzip_file.write(chunk)
-            if finishing:
-                self._gzip_file.close()
-            else:
-                self._gzip_file.flush()
-            chunk = self._gzip_value.getvalue()
-            if self._gzip_pos > 0:
-                chunk = chunk[self._gzip_pos:]
-            self._gzip_pos += len(chunk)
-        return chunk
+        if self._encoding is None:
+            return chunk
+        if self._compressor is None:
+            self._compressor = self.CODECS[self._encoding](
+                self.LEVELS.get(self._encoding))
+        start = time.time()
+        compressed = self._compressor.compress(chunk, finishing)
+        metrics = self._metrics.setdefault(self._encoding, [0, 0, 0.0])
+        metrics[0] += len(chunk)
+        metrics[1] += len(compressed)
+        metrics[2] += time.time() - start
+        return compressed
+
+    @classmethod
+    def stats(cls):
+        """Returns compression metrics for each encoding used so far."""
+        return dict((encoding, {
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "ratio": float(bytes_out) / bytes_in if bytes_in else 1.0,
+            "seconds": seconds,
+        }) for encoding, (bytes_in, bytes_out, seconds)
+            in cls._metrics.items())
+
+
+class GZipContentEncoding(ContentEncoding):
+    """Applies the gzip content encoding to the response.
+
+    This is ContentEncoding restricted to gzip, used with the gzip
+    application setting.
+    """
+    ENCODINGS = ("gzip",)
 
 
 class ChunkedTransferEncoding(OutputTransform):
@@ -1240,12 +1935,16 @@ class ChunkedTransferEncoding(OutputTransform):
 
     def transform_chunk(self, block, finishing):
         if self._chunking:
-            # Don't write out empty chunks because that means END-OF-STREAM
-            # with chunked encoding
+            # The framing goes in separate buffers so the block itself is
+            # never copied. Don't write out empty chunks because that means
+            # END-OF-STREAM with chunked encoding
+            buffers = []
             if block:
-                block = ("%x" % len(block)) + "\r\n" + block + "\r\n"
+                buffers = [("%x\r\n" % len(block)).encode("ascii"), block,
+                           b"\r\n"]
             if finishing:
-                block += "0\r\n\r\n"
+                buffers.append(b"0\r\n\r\n")
+            return buffers
         return block
 
 
@@ -1367,6 +2066,222 @@ class URLSpec:
 
 url = URLSpec
 
+class _CachedResponse:
+    """A response stored by the cached decorator."""
+    def __init__(self, status_code, headers, body, created, ttl, stale):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.created = created
+        self.expires = self.created + ttl
+        self.stale_until = self.expires + stale
+        self.revalidating = False
+
+
+class _RevalidationConnection:
+    """Stands in for the HTTPConnection of a background cache revalidation.
+
+    The response only needs to reach the response cache, so everything
+    written to it is discarded.
+    """
+    xheaders = False
+
+    class stream:
+        @staticmethod
+        def set_close_callback(callback):
+            pass
+
+    def write(self, chunk):
+        pass
+
+    def write_file(self, file, offset=0, count=None):
+        file.close()
+
+    def finish(self):
+        pass
+
+
+class _StaticFile:
+    """What StaticFileHandler knows about a file in Application.static_cache.
+
+    content is None for files larger than max_file_size. variants maps
+    content codings to precompressed copies of content, and only holds
+    encodings that actually make the file smaller.
+    """
+    COMPRESSIBLE_TYPES = ContentEncoding.CONTENT_TYPES | set([
+        "application/javascript", "image/svg+xml"])
+
+    def __init__(self, abspath, stat_result, max_file_size):
+        self.abspath = abspath
+        self.signature = (stat_result.st_mtime, stat_result.st_ino,
+                          stat_result.st_size)
+        self.checked = time.time()
+        self.modified = int(stat_result[stat.ST_MTIME])
+        self.size = stat_result[stat.ST_SIZE]
+        self.mime_type = mimetypes.guess_type(abspath)[0]
+        self.content = None
+        self.variants = {}
+        if self.size > max_file_size:
+            return
+        file = open(abspath, "rb")
+        try:
+            self.content = file.read()
+        finally:
+            file.close()
+        self.size = len(self.content)
+        if self.mime_type in self.COMPRESSIBLE_TYPES:
+            self.variants["gzip"] = gzip.compress(self.content, 9, mtime=0)
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(self.content)
+            for encoding, data in list(self.variants.items()):
+                if len(data) >= self.size:
+                    del self.variants[encoding]
+
+    def memory_size(self):
+        size = len(self.abspath)
+        if self.content is not None:
+            size += len(self.content)
+        return size + sum(len(data) for data in self.variants.values())
+
+
+def _get_template_loader(template_path, settings):
+    """Returns the shared template.Loader for the given directory.
+
+    Loaders are kept in an LRU cache bounded by the
+    template_loader_cache_entries setting, and each loader keeps at most
+    template_cache_entries templates whose code totals at most
+    template_cache_bytes characters. All three are unbounded by default.
+
+    The fragment_cache setting gives the store for {% cache %} blocks
+    (e.g., a cache.FileStore shared by pre-forked processes).
+    """
+    if getattr(RequestHandler, "_templates", None) is None:
+        RequestHandler._templates = cache.LRUCache(
+            max_entries=settings.get("template_loader_cache_entries"))
+    loader = RequestHandler._templates.get(template_path)
+    if loader is None:
+        bytecode_cache = None
+        if settings.get("template_cache_path"):
+            bytecode_cache = template.BytecodeCache(
+                settings["template_cache_path"])
+        loader = template.Loader(
+            template_path, bytecode_cache=bytecode_cache,
+            auto_reload=settings.get("debug", False),
+            max_templates=settings.get("template_cache_entries"),
+            max_code_size=settings.get("template_cache_bytes"),
+            fragment_store=settings.get("fragment_cache"))
+        RequestHandler._templates[template_path] = loader
+    return loader
+
+
+def _parse_http_date(value):
+    """Returns the HTTP date in value as a UTC timestamp, or None."""
+    if not value:
+        return None
+    date_tuple = email.utils.parsedate_tz(value)
+    if date_tuple is None:
+        return None
+    return email.utils.mktime_tz(date_tuple)
+
+
+def _negotiate_encoding(accept_encoding, encodings):
+    """Returns the coding in encodings an Accept-Encoding value prefers.
+
+    We parse quality values, so "gzip;q=0" rules out gzip, and "*" stands
+    for every coding not named explicitly. Ties go to the coding that comes
+    first in encodings. Returns None if no coding is acceptable. See
+    RFC 2616 section 14.3.
+    """
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, sep, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, sep, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        coding = coding.strip().lower()
+        if coding:
+            qualities[coding] = quality
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _parse_range_header(value, size):
+    """Parses a Range header into a list of (start, end) byte offsets.
+
+    end is exclusive. Returns None if the header is malformed or asks for
+    too many ranges, in which case it should be ignored, and an empty list
+    if none of the ranges can be satisfied. See RFC 2616 section 14.35.
+    """
+    unit, sep, specs = value.partition("=")
+    if unit.strip() != "bytes" or not sep:
+        return None
+    specs = specs.split(",")
+    if len(specs) > _MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        if not (first or last) or (first and not first.isdigit()) or \
+           (last and not last.isdigit()):
+            return None
+        if not first:
+            # A suffix range asks for the last bytes of the file
+            start = max(size - int(last), 0) if int(last) else size
+            end = size
+        else:
+            start = int(first)
+            end = size
+            if last:
+                if int(last) < start:
+                    return None
+                end = min(int(last) + 1, size)
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+
+_MAX_RANGES = 32
+
+
+def _manifest_signature(path):
+    """Like cache.file_signature, but without the inode, which copying
+    changes."""
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return (stat_result.st_mtime, stat_result.st_size)
+
+
+# The encoded status line for every status code, keyed by (version, code)
+_STATUS_LINES = dict(
+    ((version, code),
+     ("%s %d %s\r\n" % (version, code, reason)).encode("utf8"))
+    for version in ("HTTP/1.0", "HTTP/1.1")
+    for code, reason in http.client.responses.items())
+
+_UNSAFE_HEADER_CHARS = re.compile(r"[\x00-\x1f]")
+
+# Encoded header lines for headers whose values rarely vary between
+# responses, keyed by (name, value)
+_HEADER_LINES = {}
+_MAX_HEADER_LINES = 1000
+_CONSTANT_HEADERS = frozenset([
+    "Server", "Content-Type", "Cache-Control", "Connection", "Vary",
+    "Content-Encoding", "Transfer-Encoding", "Accept-Ranges"])
+
+
 def _time_independent_equals(a, b):
     if len(a) != len(b):
         return False
@@ -0,0 +1,64 @@
+from psyclone import cache
+
+def test_get_and_set():
+    lru = cache.LRUCache()
+    lru["a"] = 1
+    assert lru.get("a") == 1
+    assert lru.get("b") is None
+    assert lru.stats()["hits"] == 1
+    assert lru.stats()["misses"] == 1
+
+def test_max_entries():
+    '''The least recently used entry is evicted first.'''
+    lru = cache.LRUCache(max_entries=2)
+    lru["a"] = 1
+    lru["b"] = 2
+    lru.get("a")
+    lru["c"] = 3
+    assert "b" not in lru
+    assert sorted(lru) == ["a", "c"]
+    assert lru.evictions == 1
+
+def test_max_size():
+    '''Entries are evicted until the total size fits.'''
+    lru = cache.LRUCache(max_size=10, sizeof=len)
+    lru["a"] = "xxxx"
+    lru["b"] = "xxxx"
+    lru["c"] = "xxxx"
+    assert sorted(lru) == ["b", "c"]
+    assert lru.size == 8
+    lru["b"] = "x"
+    assert lru.size == 5
+
+def test_too_large():
+    '''Values larger than the whole cache are not stored.'''
+    lru = cache.LRUCache(max_size=3, sizeof=len)
+    lru["a"] = "xx"
+    lru["b"] = "xxxx"
+    assert "b" not in lru
+    assert "a" in lru
+
+def test_pop_and_delete():
+    lru = cache.LRUCache(max_size=10, sizeof=len)
+    lru["a"] = "xx"
+    assert lru.pop("a") == "xx"
+    assert lru.size == 0
+    lru["b"] = "x"
+    del lru["b"]
+    assert len(lru) == 0
+
+def test_memory_store_expiry():
+    '''Values expire after their ttl, and never expire without one.'''
+    store = cache.MemoryStore()
+    store.set("a", "value", -1)
+    assert store.get("a") is None
+    store.set("b", "value")
+    assert store.get("b") == "value"
+
+def test_file_store(tmpdir):
+    store = cache.FileStore(str(tmpdir))
+    store.set("a", "value", 60)
+    assert cache.FileStore(str(tmpdir)).get("a") == "value"
+    store.set("b", "value", -1)
+    assert store.get("b") is None
+    assert store.get("c") is None
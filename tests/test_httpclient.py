@@ -0,0 +1,166 @@
+from psyclone import httpclient
+from psyclone import ioloop
+import datetime
+import io
+
+def test_response_buffer():
+    buffer = httpclient._ResponseBuffer()
+    buffer.write(b"ab")
+    buffer.write(b"cd")
+    assert buffer.getvalue() == b"abcd"
+
+def test_response_buffer_preallocated():
+    buffer = httpclient._ResponseBuffer()
+    buffer.expect(4)
+    buffer.write(b"ab")
+    assert buffer.getvalue() == b"ab"
+    buffer.write(b"cd")
+    assert buffer.getvalue() == b"abcd"
+    # More than the server announced
+    buffer.write(b"ef")
+    assert buffer.getvalue() == b"abcdef"
+
+def test_header_callback():
+    headers = {}
+    buffer = httpclient._ResponseBuffer()
+    for line in (b"HTTP/1.1 200 OK\r\n", b"Content-Length: 3\r\n",
+                 b"X-Name: caf\xe9\r\n", b"\r\n"):
+        httpclient._curl_header_callback(headers, buffer, line)
+    assert headers == {"Content-Length": "3", "X-Name": "caf\xe9"}
+    assert len(buffer._buffer) == 3
+
+def test_request_body():
+    for body in (b"data", "data", bytearray(b"data"), memoryview(b"data")):
+        request_body = httpclient._RequestBody(body)
+        assert request_body.size == 4
+        assert request_body.read(3) + request_body.read(3) == b"data"
+        request_body.rewind()
+        assert request_body.read(10) == b"data"
+    body_file = io.BytesIO(b"skip:data")
+    body_file.seek(5)
+    request_body = httpclient._RequestBody(body_file)
+    assert request_body.size == 4
+    assert request_body.read(10) == b"data"
+    request_body.rewind()
+    assert request_body.read(2) == b"da"
+
+def test_timing_stats():
+    stats = httpclient.TimingStats()
+    stats.add("http://example.com/a", {"queue": 0.002, "total": 0.3})
+    stats.add("http://example.com:80/b", {"queue": 0.0, "total": 20.0})
+    assert stats.hosts() == ["example.com:80"]
+    total = stats.get("example.com:80")["total"]
+    assert total["count"] == 2
+    assert dict(total["buckets"])[0.5] == 1
+    assert dict(total["buckets"])[float("inf")] == 1
+
+def test_request_queue_priority_and_fairness():
+    queue = httpclient.RequestQueue()
+    for i in range(3):
+        queue.append("slow:80", 1, "slow%d" % i)
+    queue.append("a:80", 1, "a0")
+    queue.append("a:80", 1, "a1")
+    queue.append("b:80", 0, "urgent")
+    assert queue.stats() == {"depth": 6, "max_depth": 6,
+                             "priorities": {0: 1, 1: 5},
+                             "hosts": {"slow:80": 3, "a:80": 2, "b:80": 1}}
+    order = [queue.pop()[1] for i in range(len(queue))]
+    assert order == ["urgent", "slow0", "a0", "slow1", "a1", "slow2"]
+    assert not queue and queue.pop() is None
+    assert queue.stats()["max_depth"] == 6
+
+def test_request_queue_can_start():
+    queue = httpclient.RequestQueue()
+    queue.append("slow:80", 0, "slow0")
+    queue.append("fast:80", 0, "fast0")
+    queue.append("fast:80", 0, "fast1", first=True)
+    can_start = lambda key: key != "slow:80"
+    assert queue.pop(can_start) == ("fast:80", "fast1")
+    assert queue.pop(can_start) == ("fast:80", "fast0")
+    assert queue.pop(can_start) is None
+    assert queue.pop() == ("slow:80", "slow0")
+
+def test_request_headers_not_shared():
+    request = httpclient.HTTPRequest("http://example.com/",
+                                     if_modified_since=datetime.datetime.now())
+    assert "If-Modified-Since" in request.headers
+    assert "If-Modified-Since" not in httpclient.HTTPRequest("/").headers
+
+def test_cache_freshness():
+    cache = httpclient.HTTPCache()
+    request = httpclient.HTTPRequest("http://example.com/")
+    def store(headers):
+        response = httpclient.HTTPResponse(request, 200, headers=headers,
+                                           body=b"body")
+        cache.update(request, response)
+        return cache.get(request)
+    assert store({"Cache-Control": "max-age=60"}).body == b"body"
+    assert store({"Cache-Control": "no-store, max-age=60"}) is None
+    assert store({"Cache-Control": "no-cache", "Etag": '"x"'}) is None
+    assert cache.prepare(request)[0].headers["If-None-Match"] == '"x"'
+    assert store({"Expires": "Thu, 01 Jan 1970 00:00:00 GMT"}) is None
+    assert store({"Date": "Mon, 11 Jan 2010 00:00:00 GMT",
+                  "Last-Modified": "Fri, 01 Jan 2010 00:00:00 GMT"})
+    assert store({}) is None
+    assert cache.prepare(request) == (request, None)
+
+def test_dns_cache():
+    io_loop = ioloop.IOLoop()
+    resolver = httpclient.DNSCache(io_loop, ttl=60)
+    results = []
+    def callback(addresses, error):
+        results.append((addresses, error))
+        if len(results) == 2:
+            io_loop.stop()
+    resolver.resolve("localhost", 80, callback)
+    resolver.resolve("localhost", 80, callback)
+    assert not results
+    io_loop.start()
+    assert results[0] == results[1] and results[0][1] is None
+    assert results[0][0][0][4][1] == 80
+    assert resolver.stats()["lookups"] == 1
+    # Cached results and numeric addresses come back at once
+    resolver.resolve("localhost", 80, callback)
+    resolver.resolve("127.0.0.1", 80, callback)
+    assert len(results) == 4
+    assert results[3][0][0][4] == ("127.0.0.1", 80)
+    assert resolver.stats()["lookups"] == 1
+
+def test_dns_cache_failure():
+    io_loop = ioloop.IOLoop()
+    resolver = httpclient.DNSCache(io_loop)
+    results = []
+    def callback(addresses, error):
+        results.append((addresses, error))
+        io_loop.stop()
+    resolver.resolve("nonexistent.invalid", 80, callback)
+    io_loop.start()
+    assert results[0][0] is None and results[0][1] is not None
+    assert resolver.stats()["failures"] == 1
+
+def test_cache_authenticated():
+    cache = httpclient.HTTPCache()
+    url = "http://example.com/"
+    alice = httpclient.HTTPRequest(url, auth_username="alice",
+                                   auth_password="secret")
+    bob = httpclient.HTTPRequest(url, auth_username="bob",
+                                 auth_password="secret")
+    bearer = httpclient.HTTPRequest(url,
+                                    headers={"Authorization": "Bearer x"})
+    anonymous = httpclient.HTTPRequest(url)
+    def store(request, cache_control):
+        cache.update(request, httpclient.HTTPResponse(
+            request, 200, headers={"Cache-Control": cache_control,
+                                   "Etag": '"x"'},
+            body=request.auth_username or b"anonymous"))
+    store(alice, "max-age=60")
+    for request in (alice, bob, bearer, anonymous):
+        assert cache.get(request) is None
+        assert cache.prepare(request) == (request, None)
+    # Anonymous responses are not used for authenticated requests
+    store(anonymous, "max-age=60")
+    assert cache.get(anonymous).body == b"anonymous"
+    assert cache.get(bob) is None and cache.get(bearer) is None
+    store(alice, "public, max-age=60")
+    assert cache.get(bob).body == "alice"
+    assert cache.get(anonymous).body == "alice"
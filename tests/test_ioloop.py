@@ -1,5 +1,6 @@
 from psyclone import ioloop
 import os
+import threading
 import time 
 
 LEGAL_TIMEOUT = 0.5 # If a timeout is late by this many seconds, fail
@@ -37,7 +38,7 @@ def test_run_loop(IOloop):
             checker.val = val
             IOloop.stop()
     def send_val():
-        writer.write("ho")
+        writer.write(b"ho")
     IOloop.add_handler(fdr, read_callback, IOloop.READ)
     IOloop.add_callback(send_val)
     IOloop.start()
@@ -78,3 +79,17 @@ def test_periodic(IOloop):
         assert check > start + count * 0.2
         assert check < start + count * 0.2 + LEGAL_TIMEOUT
 
+
+def test_wake_from_thread():
+    '''Callbacks added from another thread wake the loop at once, rather
+    than waiting for the poll timeout.'''
+    io_loop = ioloop.IOLoop()
+    class checker:
+        pass
+    def add_from_thread():
+        time.sleep(0.05)
+        checker.added = time.time()
+        io_loop.add_callback(io_loop.stop)
+    threading.Thread(target=add_from_thread).start()
+    io_loop.start()
+    assert time.time() - checker.added < 0.15
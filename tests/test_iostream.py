@@ -1,62 +1,144 @@
+from psyclone import ioloop
 from psyclone import iostream
 import socket
 
-def pytest_funcarg__server_socket(request):
-    '''Funcarg to create a UDP socket that can be communicated with. Why UDP
-    when the httpserver we'll be testing is tcp?  So we don't have to set up an
-    entire socket server using listen and accept. We're testing iostream now,
-    not httpserver.
-    
-    A better solution is probably to create a mock object.'''
-    read_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    read_socket.bind(("localhost", 9562))
-    request.addfinalizer(lambda: read_socket.close())
-    return read_socket
-
-def pytest_funcarg__bound_socket(request):
-    '''Funcarg to create a socket that communicates with the socket above.'''
-    write_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    write_socket.connect(("localhost", 9562))
-    request.addfinalizer(lambda: write_socket.close())
-    return write_socket
-
-def test_read_until(IOloop, server_socket, bound_socket):
-    stream = iostream.IOStream(server_socket, IOloop)
-    class checker:
-        pass
-    def onread(data):
-        checker.data = data
-        IOloop.stop()
-    def send_val():
-        bound_socket.send(b"This is a line.\na second line")
-    stream.read_until('\n', onread)
-    IOloop.add_callback(send_val)
-    IOloop.start()
-    assert checker.data == "This is a line.\n"
-
-def test_read_bytes(IOloop, server_socket, bound_socket):
-    stream = iostream.IOStream(server_socket, IOloop)
-    class checker:
-        pass
-    def onread(data):
-        checker.data = data
-        IOloop.stop()
-    def send_val():
-        bound_socket.send(b"This is a line.\na second line")
-    stream.read_bytes(5, onread)
-    IOloop.add_callback(send_val)
-    IOloop.start()
-    assert checker.data == 'This '
-
-def test_write(IOloop, server_socket, bound_socket):
-    rcv_stream = iostream.IOStream(server_socket, IOloop)
-    send_stream = iostream.IOStream(bound_socket, IOloop)
-    class checker:
-        pass
-    def onread(data):
-        checker.data = data
-        IOloop.stop()
-    send_stream.write(b'This is a line\n')
-    rcv_stream.read_until('\n', onread)
-    IOloop.start()
-    assert checker.data == 'This is a line\n'
+def write_and_read(stream, io_loop, other, writes):
+    '''Queues the given writes on stream and returns what other receives.'''
+    # Stop if the stream is closed early, rather than waiting forever
+    stream.set_close_callback(io_loop.stop)
+    for write in writes:
+        write(stream)
+    stream.write(b"", io_loop.stop)
+    io_loop.start()
+    stream.close()
+    received = []
+    while True:
+        data = other.recv(65536)
+        if not data:
+            return b"".join(received)
+        received.append(data)
+
+def read_from(stream, io_loop, other, read, data):
+    '''Starts read on stream, sends data from other, and returns what the
+    read's callback got.'''
+    results = []
+    def callback(result):
+        results.append(result)
+        io_loop.stop()
+    read(stream, callback)
+    io_loop.add_callback(lambda: other.sendall(data))
+    io_loop.start()
+    return results[0]
+
+def test_read_until():
+    io_loop = ioloop.IOLoop()
+    ours, other = socket.socketpair()
+    stream = iostream.IOStream(ours, io_loop=io_loop)
+    data = read_from(stream, io_loop, other,
+                     lambda s, callback: s.read_until("\n", callback),
+                     b"This is a line.\na second line")
+    assert data == "This is a line.\n"
+    # The rest stays buffered for the next read
+    results = []
+    stream.read_bytes(6, results.append)
+    assert results == ["a seco"]
+
+def test_read_bytes():
+    io_loop = ioloop.IOLoop()
+    ours, other = socket.socketpair()
+    stream = iostream.IOStream(ours, io_loop=io_loop, encoding=None)
+    data = read_from(stream, io_loop, other,
+                     lambda s, callback: s.read_bytes(5, callback),
+                     b"This is a line.\n")
+    assert data == b"This "
+    results = []
+    stream.read_until(b"\n", results.append)
+    assert results == [b"is a line.\n"]
+
+def test_read_until_close():
+    io_loop = ioloop.IOLoop()
+    ours, other = socket.socketpair()
+    stream = iostream.IOStream(ours, io_loop=io_loop, encoding=None)
+    def send_and_close():
+        other.sendall(b"everything")
+        other.close()
+    results = []
+    def callback(data):
+        results.append(data)
+        io_loop.stop()
+    stream.read_until_close(callback)
+    io_loop.add_callback(send_and_close)
+    io_loop.start()
+    assert results == [b"everything"]
+    assert stream.closed()
+
+def test_write():
+    io_loop = ioloop.IOLoop()
+    ours, other = socket.socketpair()
+    send_stream = iostream.IOStream(ours, io_loop=io_loop)
+    rcv_stream = iostream.IOStream(other, io_loop=io_loop)
+    results = []
+    def callback(data):
+        results.append(data)
+        io_loop.stop()
+    send_stream.write(b"This is a line\n")
+    rcv_stream.read_until("\n", callback)
+    io_loop.start()
+    assert results == ["This is a line\n"]
+
+def test_write_file(tmpdir):
+    '''Files are written in order with the buffers around them.'''
+    body = bytes(range(256)) * 200
+    path = tmpdir.join("data")
+    path.write_binary(body)
+    io_loop = ioloop.IOLoop()
+    ours, other = socket.socketpair()
+    stream = iostream.IOStream(ours, io_loop=io_loop)
+    stream.FILE_CHUNK_SIZE = 4096
+    received = write_and_read(stream, io_loop, other, [
+        lambda s: s.write(b"head"),
+        lambda s: s.write_file(open(str(path), "rb"), 100, 20000),
+        lambda s: s.write(b"tail"),
+    ])
+    assert received == b"head" + body[100:20100] + b"tail"
+
+def test_write_file_without_sendfile(tmpdir):
+    body = b"0123456789" * 1000
+    path = tmpdir.join("data")
+    path.write_binary(body)
+    io_loop = ioloop.IOLoop()
+    ours, other = socket.socketpair()
+    stream = iostream.IOStream(ours, io_loop=io_loop)
+    stream._sendfile = False
+    received = write_and_read(stream, io_loop, other, [
+        lambda s: s.write_file(open(str(path), "rb")),
+    ])
+    assert received == body
+
+def test_write_empty_file(tmpdir):
+    path = tmpdir.join("empty")
+    path.write_binary(b"")
+    io_loop = ioloop.IOLoop()
+    ours, other = socket.socketpair()
+    stream = iostream.IOStream(ours, io_loop=io_loop)
+    received = write_and_read(stream, io_loop, other, [
+        lambda s: s.write(b"head"),
+        lambda s: s.write_file(open(str(path), "rb")),
+        lambda s: s.write_file(open(str(path), "rb"), 0, 0),
+        lambda s: s.write(b"tail"),
+    ])
+    assert received == b"headtail"
+
+def test_write_buffers():
+    '''Lists of buffers are written in order, across partial sends.'''
+    io_loop = ioloop.IOLoop()
+    ours, other = socket.socketpair()
+    stream = iostream.IOStream(ours, io_loop=io_loop)
+    stream.MAX_IOVECS = 3
+    buffers = [b"%d," % i for i in range(100)] + [b"x" * 50000]
+    received = write_and_read(stream, io_loop, other, [
+        lambda s: s.write(buffers[:50]),
+        lambda s: s.write(b""),
+        lambda s: s.write(buffers[50:]),
+    ])
+    assert received == b"".join(buffers)
@@ -0,0 +1,264 @@
+from psyclone import httpclient
+from psyclone import httpserver
+from psyclone import ioloop
+from psyclone import simple_httpclient
+from psyclone import web
+import gzip
+import io
+import socket
+import tempfile
+import time
+
+class Hello(web.RequestHandler):
+    def get(self):
+        self.write("Hello")
+
+    def post(self):
+        self.write("Got " + self.request.body)
+
+class Chunked(web.RequestHandler):
+    def get(self):
+        self.write("first,")
+        self.flush()
+        self.write("second")
+
+class Redirect(web.RequestHandler):
+    def get(self):
+        self.redirect("/hello")
+
+class Compressed(web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Encoding", "gzip")
+        self.write(gzip.compress(b"zipped"))
+
+class Hang(web.RequestHandler):
+    @web.asynchronous
+    def get(self):
+        pass
+
+class Cached(web.RequestHandler):
+    requests = []
+
+    def get(self, max_age):
+        Cached.requests.append(self.request.headers.get("If-None-Match"))
+        self.set_header("Cache-Control", "max-age=" + max_age)
+        self.write("cached")
+
+def start_server(**kwargs):
+    '''Returns a new IOLoop, a client on it and the base URL of a server.'''
+    io_loop = ioloop.IOLoop()
+    application = web.Application([
+        (r"/hello", Hello),
+        (r"/chunked", Chunked),
+        (r"/redirect", Redirect),
+        (r"/compressed", Compressed),
+        (r"/cached/(\d+)", Cached),
+        (r"/hang", Hang),
+    ])
+    server = httpserver.HTTPServer(application, io_loop=io_loop)
+    server.bind(0, "127.0.0.1")
+    server.start(1)
+    port = server._socket.getsockname()[1]
+    client = simple_httpclient.SimpleAsyncHTTPClient(io_loop=io_loop,
+                                                     **kwargs)
+    return io_loop, client, "http://127.0.0.1:%d" % port
+
+def fetch(io_loop, client, url, **kwargs):
+    responses = []
+    def callback(response):
+        responses.append(response)
+        io_loop.stop()
+    # Give up rather than hang if the callback is never run
+    timeout = io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    client.fetch(url, callback, **kwargs)
+    io_loop.start()
+    assert responses, "fetch of %s never finished" % url
+    io_loop.remove_timeout(timeout)
+    return responses[0]
+
+def test_fetch():
+    io_loop, client, base = start_server()
+    response = fetch(io_loop, client, base + "/hello")
+    assert response.code == 200
+    assert response.body == b"Hello"
+    assert response.headers["Content-Length"] == "5"
+    response = fetch(io_loop, client, base + "/hello", method="POST",
+                     body="data")
+    assert response.body == b"Got data"
+    assert fetch(io_loop, client, base + "/missing").code == 404
+
+def test_keep_alive():
+    '''Later requests to the same server reuse the first connection.'''
+    io_loop, client, base = start_server()
+    for i in range(3):
+        assert fetch(io_loop, client, base + "/hello").body == b"Hello"
+    assert client.pool.stats()["misses"] == 1
+    assert client.pool.stats()["hits"] == 2
+
+def test_chunked_and_gzip():
+    io_loop, client, base = start_server()
+    assert fetch(io_loop, client, base + "/chunked").body == b"first,second"
+    assert fetch(io_loop, client, base + "/compressed").body == b"zipped"
+
+def test_redirect():
+    io_loop, client, base = start_server()
+    response = fetch(io_loop, client, base + "/redirect")
+    assert response.body == b"Hello"
+    assert response.effective_url == base + "/hello"
+    assert response.request.url == base + "/redirect"
+
+def test_connection_refused():
+    io_loop, client, base = start_server()
+    response = fetch(io_loop, client, "http://127.0.0.1:1/")
+    assert response.code == 599
+    assert response.error is not None
+
+def test_pool_eviction():
+    io_loop = ioloop.IOLoop()
+    pool = simple_httpclient.ConnectionPool(io_loop, max_idle=1)
+    class FakeStream:
+        closed_count = 0
+        def close(self):
+            FakeStream.closed_count += 1
+    first, second = FakeStream(), FakeStream()
+    pool.put(("http", "a", 80), first)
+    pool.put(("http", "b", 80), second)
+    assert FakeStream.closed_count == 1
+    assert pool.stats()["evictions"] == 1
+    assert pool.stats()["idle"] == 1
+
+def test_time_info():
+    io_loop, client, base = start_server()
+    response = fetch(io_loop, client, base + "/hello")
+    info = response.time_info
+    assert 0 <= info["connect"] <= info["starttransfer"] <= info["total"]
+    assert info["queue"] >= 0
+    host = "127.0.0.1:%s" % base.rsplit(":", 1)[1]
+    stats = client.timing.get(host)
+    assert stats["total"]["count"] == 1
+    assert sum(count for bound, count in stats["total"]["buckets"]) == 1
+
+def test_body_types(tmpdir):
+    io_loop, client, base = start_server()
+    path = tmpdir.join("body")
+    path.write_binary(b"skip:from file")
+    bodies = [b"bytes", memoryview(b"view"), io.BytesIO(b"buffered")]
+    with open(str(path), "rb") as body_file:
+        body_file.seek(5)
+        for body in bodies + [body_file]:
+            response = fetch(io_loop, client, base + "/hello", method="POST",
+                             body=body)
+            assert response.code == 200
+        assert response.body == b"Got from file"
+        # The caller's file is still open
+        assert body_file.read() == b"from file"
+    with tempfile.TemporaryFile() as empty:
+        response = fetch(io_loop, client, base + "/hello", method="POST",
+                         body=empty)
+        assert response.body == b"Got "
+
+def test_cache():
+    io_loop, client, base = start_server(cache=httpclient.HTTPCache())
+    del Cached.requests[:]
+    for i in range(2):
+        response = fetch(io_loop, client, base + "/cached/60")
+        assert response.code == 200 and response.body == b"cached"
+    assert Cached.requests == [None]
+    # Stale responses are revalidated with their Etag
+    for i in range(2):
+        response = fetch(io_loop, client, base + "/cached/0")
+        assert response.code == 200 and response.body == b"cached"
+        assert response.request.headers.get("If-None-Match") is None
+    etag = response.headers["Etag"]
+    assert Cached.requests == [None, None, etag]
+    stats = client.cache.stats()
+    assert stats["fresh_hits"] == 1
+    assert stats["revalidations"] == 1
+    # Conditional requests go to the server
+    response = fetch(io_loop, client, base + "/cached/60",
+                     headers={"If-None-Match": etag})
+    assert response.code == 304
+
+def test_coalesce():
+    io_loop, client, base = start_server(coalesce=True)
+    del Cached.requests[:]
+    responses = []
+    def callback(response):
+        responses.append(response)
+        if len(responses) == 4:
+            io_loop.stop()
+    for i in range(3):
+        client.fetch(base + "/cached/0", callback)
+    client.fetch(base + "/cached/0", callback, headers={"X-Other": "1"})
+    io_loop.start()
+    assert len(Cached.requests) == 2
+    assert [response.body for response in responses] == [b"cached"] * 4
+    assert len(set(id(response.request) for response in responses)) == 4
+    assert client.coalescer.stats() == {
+        "in_flight": 0, "fetched": 2, "coalesced": 2}
+
+def test_fetch_many():
+    io_loop, client, base = start_server()
+    started = []
+    def requests():
+        for i in range(5):
+            started.append(i)
+            yield base + "/hello"
+    responses = []
+    def on_response(response):
+        # Only two requests are ever in flight
+        assert len(started) - len(responses) <= 2
+        responses.append(response)
+    client.fetch_many(requests(), on_response, io_loop.stop, concurrency=2)
+    io_loop.start()
+    assert [response.body for response in responses] == [b"Hello"] * 5
+    assert client.pool.stats()["misses"] == 2
+
+def test_fetch_iter():
+    io_loop, client, base = start_server()
+    urls = [base + "/hello", base + "/missing", base + "/chunked"]
+    codes = sorted(response.code for response in
+                   httpclient.fetch_iter(client, urls, concurrency=2))
+    assert codes == [200, 200, 404]
+
+def test_resolve_failure():
+    io_loop, client, base = start_server()
+    response = fetch(io_loop, client, "http://nonexistent.invalid/")
+    assert response.code == 599
+    assert "Could not resolve" in str(response.error)
+    assert client.resolver.stats()["failures"] == 1
+
+def test_connect_timeout():
+    io_loop, client, base = start_server(max_clients=1)
+    # Fill the backlog of a server that never accepts, so connecting hangs
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    pending = []
+    while True:
+        sock = socket.socket()
+        sock.setblocking(False)
+        pending.append(sock)
+        if sock.connect_ex(listener.getsockname()) != 0:
+            break
+    url = "http://127.0.0.1:%d/" % listener.getsockname()[1]
+    try:
+        response = fetch(io_loop, client, url, connect_timeout=0.2,
+                         request_timeout=0.5)
+        assert response.code == 599
+        assert "Connect timeout" in str(response.error)
+        # The slot is freed and the request timeout does not fire later
+        assert fetch(io_loop, client, base + "/hello").body == b"Hello"
+        io_loop.add_timeout(time.time() + 0.6, io_loop.stop)
+        io_loop.start()
+    finally:
+        for sock in pending:
+            sock.close()
+        listener.close()
+
+def test_request_timeout():
+    io_loop, client, base = start_server(max_clients=1)
+    response = fetch(io_loop, client, base + "/hang", request_timeout=0.2)
+    assert response.code == 599
+    assert str(response.error) == "HTTP 599: Timeout"
+    assert fetch(io_loop, client, base + "/hello").body == b"Hello"
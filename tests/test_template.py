@@ -0,0 +1,141 @@
+from psyclone import cache
+from psyclone import template
+import os
+
+def write_templates(tmpdir):
+    '''Create a small template tree that uses both extends and include.'''
+    tmpdir.join("base.html").write(
+        "<title>{% block title %}Base{% end %}</title>"
+        "{% include \"footer.html\" %}")
+    tmpdir.join("footer.html").write("<p>{{ name }}</p>")
+    tmpdir.join("page.html").write(
+        "{% extends \"base.html\" %}{% block title %}{{ name }}{% end %}")
+
+def test_generate():
+    t = template.Template("<b>{{ value }}</b>")
+    assert t.generate(value="hi") == "<b>hi</b>"
+
+def test_dependencies(tmpdir):
+    '''Templates record the checksums of everything they extend or include.'''
+    write_templates(tmpdir)
+    loader = template.Loader(str(tmpdir))
+    page = loader.load("page.html")
+    base = loader.load("base.html")
+    assert page.dependencies == {"base.html": base.checksum}
+    assert base.dependencies == {
+        "footer.html": loader.load("footer.html").checksum}
+
+def test_checksum_covers_dependencies(tmpdir):
+    '''Changing an included template changes the checksum of its parents.'''
+    write_templates(tmpdir)
+    before = template.Loader(str(tmpdir)).load("page.html").checksum
+    tmpdir.join("footer.html").write("<div>{{ name }}</div>")
+    after = template.Loader(str(tmpdir)).load("page.html").checksum
+    assert before != after
+
+def test_bytecode_cache(tmpdir):
+    '''A second loader reuses the compiled code written by the first.'''
+    write_templates(tmpdir.mkdir("templates"))
+    cache_dir = str(tmpdir.join("cache"))
+    loader = template.Loader(str(tmpdir.join("templates")),
+        bytecode_cache=template.BytecodeCache(cache_dir))
+    expected = loader.load("page.html").generate(name="x")
+    assert len(os.listdir(cache_dir)) == 3
+
+    class checker:
+        compiled = 0
+    class CountingCache(template.BytecodeCache):
+        def dump(self, checksum, dependencies, code, compiled):
+            checker.compiled += 1
+            super().dump(checksum, dependencies, code, compiled)
+    loader = template.Loader(str(tmpdir.join("templates")),
+        bytecode_cache=CountingCache(cache_dir))
+    page = loader.load("page.html")
+    assert page.generate(name="x") == expected
+    assert checker.compiled == 0
+    # Cache hits are not even parsed
+    assert page._file is None
+
+def test_bytecode_cache_dependencies(tmpdir):
+    '''Cached code is not used once a template it includes has changed.'''
+    write_templates(tmpdir.mkdir("templates"))
+    cache_dir = str(tmpdir.join("cache"))
+    def load():
+        loader = template.Loader(str(tmpdir.join("templates")),
+            bytecode_cache=template.BytecodeCache(cache_dir))
+        return loader.load("page.html").generate(name="x")
+    assert "<p>x</p>" in load()
+    tmpdir.join("templates", "footer.html").write("<div>{{ name }}</div>")
+    assert "<div>x</div>" in load()
+
+def test_corrupt_bytecode_cache(tmpdir):
+    '''Corrupt cache entries are ignored rather than raising.'''
+    cache = template.BytecodeCache(str(tmpdir))
+    t = template.Template("{{ 1 + 1 }}")
+    open(cache._path(t.checksum), "wb").write(b"garbage")
+    assert cache.load(t.checksum) is None
+
+def test_auto_reload(tmpdir):
+    '''Editing an included template recompiles the pages that use it.'''
+    write_templates(tmpdir)
+    loader = template.Loader(str(tmpdir), auto_reload=True)
+    page = loader.load("page.html")
+    assert loader.load("page.html") is page
+    footer = tmpdir.join("footer.html")
+    footer.write("<div>{{ name }}</div>")
+    footer.setmtime(footer.mtime() + 10)
+    assert "<div>x</div>" in loader.load("page.html").generate(name="x")
+
+def test_no_auto_reload(tmpdir):
+    '''Without auto_reload, templates are compiled only once.'''
+    write_templates(tmpdir)
+    loader = template.Loader(str(tmpdir))
+    page = loader.load("page.html")
+    tmpdir.join("page.html").write("changed")
+    assert loader.load("page.html") is page
+
+def test_preload(tmpdir):
+    '''preload() compiles every template, skipping hidden files.'''
+    write_templates(tmpdir)
+    tmpdir.join(".hidden.html").write("{% end %}")
+    tmpdir.mkdir("modules").join("entry.html").write("{{ entry }}")
+    loader = template.Loader(str(tmpdir))
+    names = loader.preload()
+    assert sorted(names) == ["base.html", "footer.html",
+                             os.path.join("modules", "entry.html"),
+                             "page.html"]
+    assert sorted(loader.templates) == sorted(names)
+
+def test_max_templates(tmpdir):
+    '''Loaders evict their least recently used templates.'''
+    write_templates(tmpdir)
+    loader = template.Loader(str(tmpdir), max_templates=2)
+    loader.load("footer.html")
+    loader.load("page.html")
+    assert len(loader.templates) == 2
+    assert "page.html" in loader.templates
+    assert loader.templates.stats()["evictions"] == 1
+
+def test_cache_block():
+    '''Cached fragments are rendered once per key.'''
+    class checker:
+        calls = 0
+    def expensive():
+        checker.calls += 1
+        return checker.calls
+    t = template.Template("{% for i in range(3) %}"
+                          "{% cache i % 2, 60 %}{{ expensive() }}{% end %}"
+                          "{% end %}")
+    assert t.generate(expensive=expensive) == "121"
+    assert t.generate(expensive=expensive) == "121"
+    assert checker.calls == 2
+
+def test_cache_block_file_store(tmpdir):
+    '''Fragments in a FileStore are shared by every loader using it.'''
+    tmpdir.mkdir("templates").join("page.html").write(
+        "{% cache \"page\" %}{{ value }}{% end %}")
+    store = cache.FileStore(str(tmpdir.join("fragments")))
+    for value in ("first", "second"):
+        loader = template.Loader(str(tmpdir.join("templates")),
+                                 fragment_store=store)
+        assert loader.load("page.html").generate(value=value) == "first"
@@ -0,0 +1,406 @@
+import gzip
+import hashlib
+from psyclone import httpserver
+from psyclone import ioloop
+from psyclone import web
+import time
+import zlib
+
+class FakeStream:
+    def set_close_callback(self, callback):
+        pass
+
+class FakeConnection:
+    '''Stands in for an HTTPConnection, recording what the handler writes.'''
+    xheaders = False
+
+    def __init__(self):
+        self.stream = FakeStream()
+        self.written = []
+        self.finished = False
+
+    def write(self, chunk):
+        self.written.extend(chunk if isinstance(chunk, list) else [chunk])
+
+    def finish(self):
+        self.finished = True
+
+    def response(self):
+        '''Returns the status code, headers and body that were written.'''
+        data = b"".join(self.written)
+        head, sep, body = data.partition(b"\r\n\r\n")
+        lines = head.decode("utf8").split("\r\n")
+        headers = httpserver.HTTPHeaders.parse("\r\n".join(lines[1:]))
+        return int(lines[0].split(" ")[1]), headers, body
+
+def fetch(application, uri, method="GET", headers={}):
+    '''Runs a request through the application without a server.'''
+    connection = FakeConnection()
+    request_headers = httpserver.HTTPHeaders()
+    for name, value in headers.items():
+        request_headers[name] = value
+    request = httpserver.HTTPRequest(method, uri, version="HTTP/1.1",
+        headers=request_headers, remote_ip="127.0.0.1",
+        connection=connection)
+    application(request)
+    assert connection.finished
+    return connection.response()
+
+def test_hello():
+    class Hello(web.RequestHandler):
+        def get(self):
+            self.write("Hello")
+    status, headers, body = fetch(web.Application([(r"/", Hello)]), "/")
+    assert status == 200
+    assert body == b"Hello"
+    assert headers["Content-Length"] == "5"
+
+def test_cached():
+    '''Cached responses are served without running the handler.'''
+    class checker:
+        calls = 0
+    class Counter(web.RequestHandler):
+        def prepare(self):
+            checker.calls += 1
+        @web.cached(ttl=60, vary=("Accept-Language",))
+        def get(self):
+            self.write(str(checker.calls))
+    application = web.Application([(r"/", Counter)])
+    assert fetch(application, "/")[2] == b"1"
+    assert fetch(application, "/")[2] == b"1"
+    assert fetch(application, "/?page=2")[2] == b"2"
+    french = {"Accept-Language": "fr"}
+    assert fetch(application, "/", headers=french)[2] == b"3"
+    assert checker.calls == 3
+    assert application.response_cache.stats()["hits"] == 1
+
+def test_cached_stale():
+    '''Expired responses are served stale while one request regenerates.'''
+    class checker:
+        calls = 0
+    class clock:
+        now = time.time()
+    class Counter(web.RequestHandler):
+        @web.cached(ttl=60, stale=60)
+        def get(self):
+            checker.calls += 1
+            self.write(str(checker.calls))
+    io_loop = ioloop.IOLoop()
+    application = web.Application([(r"/", Counter)], io_loop=io_loop,
+                                  response_cache_clock=lambda: clock.now)
+    assert fetch(application, "/")[2] == b"1"
+    clock.now += 90
+    # Stale requests get the old body, and only the first regenerates
+    assert fetch(application, "/")[2] == b"1"
+    assert fetch(application, "/")[2] == b"1"
+    assert checker.calls == 1
+    io_loop.add_callback(io_loop.stop)
+    io_loop.start()
+    assert checker.calls == 2
+    assert fetch(application, "/")[2] == b"2"
+    assert fetch(application, "/")[2] == b"2"
+    assert checker.calls == 2
+
+def test_cached_skips_cookies():
+    '''Responses that set cookies are never cached.'''
+    class checker:
+        calls = 0
+    class Cookie(web.RequestHandler):
+        @web.cached(ttl=60)
+        def get(self):
+            checker.calls += 1
+            self.set_cookie("visit", str(checker.calls))
+    application = web.Application([(r"/", Cookie)])
+    fetch(application, "/")
+    fetch(application, "/")
+    assert checker.calls == 2
+
+def test_etag():
+    '''Clients with the current Etag get a 304 and no body.'''
+    class Hello(web.RequestHandler):
+        def get(self):
+            self.write("Hello")
+    application = web.Application([(r"/", Hello)])
+    status, headers, body = fetch(application, "/")
+    etag = headers["Etag"]
+    status, headers, body = fetch(application, "/",
+                                  headers={"If-None-Match": etag})
+    assert status == 304
+    assert body == b""
+    assert fetch(application, "/", headers={"If-None-Match": '"x"'})[0] == 200
+
+def test_no_etag():
+    class NoEtag(web.RequestHandler):
+        def compute_etag(self):
+            return None
+        def get(self):
+            self.write("Hello")
+    status, headers, body = fetch(web.Application([(r"/", NoEtag)]), "/")
+    assert "Etag" not in headers
+
+def test_version_etag():
+    '''A matching version Etag short-circuits before get() is called.'''
+    class checker:
+        calls = 0
+    class Versioned(web.RequestHandler):
+        def get_version_etag(self, name):
+            return "v1-" + name
+        def get(self, name):
+            checker.calls += 1
+            self.write("Hello " + name)
+    application = web.Application([(r"/(.*)", Versioned)])
+    status, headers, body = fetch(application, "/bob")
+    assert headers["Etag"] == '"v1-bob"'
+    assert checker.calls == 1
+    status, headers, body = fetch(application, "/bob",
+                                  headers={"If-None-Match": '"v1-bob"'})
+    assert status == 304
+    assert checker.calls == 1
+
+def static_application(tmpdir):
+    tmpdir.join("digits.txt").write("0123456789")
+    return web.Application([], static_path=str(tmpdir))
+
+def test_static_range(tmpdir):
+    application = static_application(tmpdir)
+    status, headers, body = fetch(application, "/static/digits.txt",
+                                  headers={"Range": "bytes=2-4"})
+    assert status == 206
+    assert body == b"234"
+    assert headers["Content-Range"] == "bytes 2-4/10"
+    assert "Content-Encoding" not in headers
+    status, headers, body = fetch(application, "/static/digits.txt",
+                                  headers={"Range": "bytes=-3"})
+    assert body == b"789"
+    status, headers, body = fetch(application, "/static/digits.txt",
+                                  headers={"Range": "bytes=20-"})
+    assert status == 416
+    assert headers["Content-Range"] == "bytes */10"
+    # Malformed ranges are ignored
+    status, headers, body = fetch(application, "/static/digits.txt",
+                                  headers={"Range": "bytes=x-1"})
+    assert status == 200
+    assert body == b"0123456789"
+
+def test_static_multiple_ranges(tmpdir):
+    application = static_application(tmpdir)
+    status, headers, body = fetch(application, "/static/digits.txt",
+                                  headers={"Range": "bytes=0-1,8-"})
+    assert status == 206
+    content_type, boundary = headers["Content-Type"].split("; boundary=")
+    assert content_type == "multipart/byteranges"
+    assert int(headers["Content-Length"]) == len(body)
+    parts = body.split(("--" + boundary).encode("ascii"))
+    assert parts[1].endswith(b"Content-Range: bytes 0-1/10\r\n\r\n01\r\n")
+    assert parts[2].endswith(b"Content-Range: bytes 8-9/10\r\n\r\n89\r\n")
+    assert parts[3] == b"--\r\n"
+
+def test_static_if_range(tmpdir):
+    application = static_application(tmpdir)
+    status, headers, body = fetch(application, "/static/digits.txt")
+    current = {"Range": "bytes=0-0", "If-Range": headers["Etag"]}
+    assert fetch(application, "/static/digits.txt", headers=current)[2] == b"0"
+    current["If-Range"] = headers["Last-Modified"]
+    assert fetch(application, "/static/digits.txt", headers=current)[2] == b"0"
+    old = {"Range": "bytes=0-0", "If-Range": '"old"'}
+    assert fetch(application, "/static/digits.txt",
+                 headers=old)[2] == b"0123456789"
+
+def test_static_if_modified_since(tmpdir):
+    application = static_application(tmpdir)
+    status, headers, body = fetch(application, "/static/digits.txt")
+    status, headers, body = fetch(application, "/static/digits.txt",
+        headers={"If-Modified-Since": headers["Last-Modified"]})
+    assert status == 304
+
+def test_static_cache(tmpdir):
+    '''Small files are served from memory until they change on disk.'''
+    css = tmpdir.join("site.css")
+    css.write("body { color: red }" * 20)
+    application = web.Application([], static_path=str(tmpdir),
+                                  static_cache_check_interval=0)
+    status, headers, body = fetch(application, "/static/site.css",
+                                  headers={"Accept-Encoding": "gzip"})
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(body) == b"body { color: red }" * 20
+    status, headers, body = fetch(application, "/static/site.css",
+                                  headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in headers
+    assert body == b"body { color: red }" * 20
+    assert application.static_cache.stats()["hits"] >= 1
+
+    css.write("p {}")
+    css.setmtime(css.mtime() + 10)
+    assert fetch(application, "/static/site.css")[2] == b"p {}"
+
+def test_static_variant_etag(tmpdir):
+    '''Precompressed bodies have their own Etag.'''
+    tmpdir.join("site.css").write("body { color: red }" * 20)
+    application = web.Application([], static_path=str(tmpdir))
+    gzipped = {"Accept-Encoding": "gzip"}
+    status, headers, body = fetch(application, "/static/site.css",
+                                  headers=gzipped)
+    assert headers["Content-Encoding"] == "gzip"
+    etag = headers["Etag"]
+    status, headers, body = fetch(application, "/static/site.css")
+    assert headers["Etag"] != etag
+    identity = headers["Etag"]
+    # Ranges are served from the identity body, with its Etag
+    gzipped["Range"] = "bytes=0-3"
+    status, headers, body = fetch(application, "/static/site.css",
+                                  headers=gzipped)
+    assert status == 206 and body == b"body"
+    assert headers["Etag"] == identity
+    assert fetch(application, "/static/site.css",
+                 headers={"Accept-Encoding": "gzip",
+                          "If-None-Match": etag})[0] == 304
+
+def test_static_manifest(tmpdir):
+    '''Manifests hash files up front and rehash only what changes.'''
+    static = tmpdir.mkdir("static")
+    static.join("a.css").write("a")
+    static.mkdir("js").join("b.js").write("b")
+    static.join(".hidden").write("h")
+    manifest = web.StaticManifest(str(static))
+    manifest.build(threads=2)
+    assert sorted(manifest.entries) == ["a.css", "js/b.js"]
+    version = manifest.get("a.css")
+    assert version == hashlib.md5(b"a").hexdigest()
+
+    manifest_path = str(tmpdir.join("manifest.json"))
+    manifest.save(manifest_path)
+    loaded = web.StaticManifest(str(static))
+    loaded.load(manifest_path)
+    assert loaded.entries == manifest.entries
+
+    static.join("a.css").write("changed")
+    static.join("c.css").write("c")
+    loaded.refresh()
+    assert loaded.get("a.css") == hashlib.md5(b"changed").hexdigest()
+    assert loaded.get("c.css") == hashlib.md5(b"c").hexdigest()
+    assert loaded.get("missing.css") is None
+
+def test_static_manifest_on_demand(tmpdir):
+    '''Files added after the manifest is built are hashed when asked for.'''
+    manifest = web.StaticManifest(str(tmpdir))
+    manifest.build()
+    assert manifest.get("new.css") is None
+    assert "new.css" not in manifest.entries
+    new = tmpdir.join("new.css")
+    new.write("new")
+    assert manifest.get("new.css") == hashlib.md5(b"new").hexdigest()
+    new.write("newer")
+    new.setmtime(new.mtime() + 10)
+    assert manifest.get("new.css") == hashlib.md5(b"newer").hexdigest()
+    new.remove()
+    manifest.refresh()
+    assert "new.css" not in manifest.entries
+    assert manifest.get("new.css") is None
+
+def test_static_manifest_background_refresh(tmpdir):
+    static = tmpdir.mkdir("static")
+    static.join("a.css").write("a")
+    manifest = web.StaticManifest(str(static))
+    manifest.build()
+    io_loop = ioloop.IOLoop()
+    manifest.start_refresh(0.01, io_loop=io_loop)
+    static.join("a.css").write("changed")
+    def check():
+        if manifest.entries["a.css"][1] == hashlib.md5(b"changed").hexdigest():
+            io_loop.stop()
+    ioloop.PeriodicCallback(check, 10, io_loop=io_loop).start()
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    manifest.stop_refresh()
+    assert manifest.get("a.css") == hashlib.md5(b"changed").hexdigest()
+
+def test_static_url(tmpdir):
+    class Page(web.RequestHandler):
+        def get(self):
+            self.write(self.static_url("a.css"))
+    tmpdir.join("a.css").write("a")
+    application = web.Application([(r"/", Page)], static_path=str(tmpdir))
+    version = hashlib.md5(b"a").hexdigest()[:5]
+    assert fetch(application, "/")[2] == b"/static/a.css?v=" + version.encode()
+
+def test_gzip():
+    class Text(web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain")
+            self.write("a" * 1000)
+    application = web.Application([(r"/", Text)], gzip=True)
+    status, headers, body = fetch(application, "/",
+                                  headers={"Accept-Encoding": "gzip"})
+    assert headers["Content-Encoding"] == "gzip"
+    assert int(headers["Content-Length"]) == len(body)
+    assert gzip.decompress(body) == b"a" * 1000
+
+def test_gzip_streaming():
+    '''Each flushed chunk can be decompressed as soon as it arrives.'''
+    headers = httpserver.HTTPHeaders()
+    headers["Accept-Encoding"] = "gzip"
+    request = httpserver.HTTPRequest("GET", "/", version="HTTP/1.1",
+                                     headers=headers)
+    transform = web.GZipContentEncoding(request)
+    response_headers, chunk = transform.transform_first_chunk(
+        {"Content-Type": "text/html"}, b"first", False)
+    assert response_headers["Content-Encoding"] == "gzip"
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(chunk) == b"first"
+    chunk = transform.transform_chunk(b"second", False)
+    assert decompressor.decompress(chunk) == b"second"
+    chunk = transform.transform_chunk(b"", True)
+    assert decompressor.decompress(chunk) == b""
+    assert decompressor.eof
+
+def test_negotiate_encoding():
+    negotiate = web._negotiate_encoding
+    assert negotiate("gzip, deflate", ["br", "gzip", "deflate"]) == "gzip"
+    assert negotiate("gzip;q=0.5, deflate", ["gzip", "deflate"]) == "deflate"
+    assert negotiate("gzip;q=0", ["gzip"]) is None
+    assert negotiate("*", ["br", "gzip"]) == "br"
+    assert negotiate("*, br;q=0", ["br", "gzip"]) == "gzip"
+    assert negotiate("", ["gzip"]) is None
+
+def test_content_encoding():
+    '''Identical bodies are compressed once per encoding.'''
+    class Text(web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain")
+            self.write("unique body for the compression cache " * 20)
+    application = web.Application([(r"/", Text)], compress_response=True)
+    before = web.ContentEncoding.compressed_cache.stats()["hits"]
+    for i in range(2):
+        status, headers, body = fetch(application, "/",
+            headers={"Accept-Encoding": "deflate;q=0.5, gzip;q=0.1"})
+        assert headers["Content-Encoding"] == "deflate"
+        assert headers["Vary"] == "Accept-Encoding"
+        assert zlib.decompress(body).startswith(b"unique body")
+    assert web.ContentEncoding.compressed_cache.stats()["hits"] == before + 1
+    stats = web.ContentEncoding.stats()["deflate"]
+    assert stats["ratio"] < 1
+
+def test_chunked():
+    class Stream(web.RequestHandler):
+        def get(self):
+            self.write("first")
+            self.flush()
+            self.write("second")
+    status, headers, body = fetch(web.Application([(r"/", Stream)]), "/")
+    assert headers["Transfer-Encoding"] == "chunked"
+    assert body == b"5\r\nfirst\r\n6\r\nsecond\r\n0\r\n\r\n"
+
+def test_content_encoding_shared_etag():
+    '''Resources with the same Etag never get each other's bodies.'''
+    class Text(web.RequestHandler):
+        def get(self, name):
+            self.set_header("Content-Type", "text/plain")
+            self.set_header("Etag", '"same"')
+            self.write(("body of %s " % name) * 20)
+    application = web.Application([(r"/(\w+)", Text)],
+                                  compress_response=True)
+    for name in ("a", "b"):
+        status, headers, body = fetch(application, "/" + name,
+                                      headers={"Accept-Encoding": "gzip"})
+        assert gzip.decompress(body).startswith(("body of %s" % name).encode())